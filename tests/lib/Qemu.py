@@ -16,15 +16,29 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import asyncio
+import atexit
+import concurrent.futures
 import enum
+import fnmatch
+import hashlib
+import io
+import json
 import os
 import logging
 import paramiko
 import pathlib
+import queue
+import re
+import select
+import selectors
+import shlex
 import shutil
 import socket
 import subprocess
+import tarfile
 import tempfile
+import threading
 import time
 import sys
 import stat
@@ -276,6 +290,26 @@ class QemuCommand:
         self.command = self.command + [
             '-qmp', f'unix:{self.qmp_file},server=on,wait=off',
         ]
+        return self.qmp_file
+
+    def add_qmp_socket(self, name):
+        """
+        Additional QMP socket, for a client independent of the
+        machine QMP client (ex: sampling from another thread)
+        """
+        qmp_file = f'{self.workdir}/{name}.sock'
+        self.command = self.command + [
+            '-qmp', f'unix:{qmp_file},server=on,wait=off',
+        ]
+        return qmp_file
+
+    def add_start_paused(self):
+        """
+        Do not start the vCPUs at startup, the VM has to be started
+        with the QMP command 'cont'
+        """
+        if '-S' not in self.command:
+            self.command = self.command + ['-S']
 
     def add_vsock(self, guest_cid):
         self.command = self.command + [
@@ -383,13 +417,608 @@ class QemuMonitor():
         if self.socket is not None:
             self.socket.close()
 
+class QemuQmp():
+    """
+    Client for the QEMU Machine Protocol (QMP)
+    See https://www.qemu.org/docs/master/interop/qmp-spec.html
+
+    The client is event driven: data is read from the socket only when
+    available (no sleep polling), commands can be pipelined (send several
+    commands, then collect their responses) and asynchronous events
+    (RESUME, STOP, SHUTDOWN, POWERDOWN, ...) are recorded and dispatched
+    to subscribed callbacks.
+
+    Example:
+      qmp = QemuQmp(qm)
+      qmp.wait_for_state('running')
+      ids = [qmp.send('query-status'), qmp.send('query-cpus-fast')]
+      status, cpus = [qmp.result(i) for i in ids]
+    """
+    CONNECT_TIMEOUT = 60
+    CONNECT_RETRY_SLEEP = 0.01
+    COMMAND_TIMEOUT = 10
+    READ_SIZE = 65536
+
+    # events that signal a change of the VM run state
+    STATE_EVENTS = ['RESUME', 'STOP', 'SHUTDOWN', 'RESET', 'POWERDOWN',
+                    'SUSPEND', 'WAKEUP', 'GUEST_PANICKED']
+
+    def __new__(cls, qemu, timeout=CONNECT_TIMEOUT, qmp_file=None):
+        # client on an additional QMP socket (see QemuCommand.add_qmp_socket)
+        if qmp_file is not None:
+            return super().__new__(cls)
+        # only 1 qmp client per qemu machine
+        if qemu.qmp is None:
+            qemu.qmp = super().__new__(cls)
+        return qemu.qmp
+
+    def __init__(self, qemu, timeout=CONNECT_TIMEOUT, qmp_file=None):
+        if getattr(self, 'socket', None) is not None:
+            # client already connected
+            return
+        if qmp_file is None:
+            qmp_file = qemu.qcmd.qmp_file
+        assert qmp_file is not None, "QMP socket file is undefined"
+        self.qmp_file = qmp_file
+        self.socket = None
+        self.greeting = None
+        # all received events, in the order of reception
+        self.events = []
+        self._buffer = b''
+        self._next_id = 0
+        self._responses = {}
+        self._callbacks = {}
+        self._closed = False
+
+        self._connect(qemu, timeout)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.socket, selectors.EVENT_READ)
+
+        # wait for the greeting message and enter command mode
+        deadline = time.monotonic() + timeout
+        while self.greeting is None:
+            self._process(self._remaining(deadline))
+        self.command('qmp_capabilities')
+
+    def _connect(self, qemu, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.qmp_file)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+            # no need to wait if the qemu process is already gone
+            if qemu.proc is not None and qemu.proc.poll() is not None:
+                raise RuntimeError(f'QEMU exited before QMP connection : {self.qmp_file}')
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f'QMP connection timeout : {self.qmp_file}')
+            time.sleep(self.CONNECT_RETRY_SLEEP)
+        sock.setblocking(False)
+        self.socket = sock
+
+    @staticmethod
+    def _remaining(deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('QMP timeout')
+        return remaining
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def read_available(self):
+        """
+        Read and dispatch all the data currently available on the socket
+        Does not block, used by QemuQmpSelector
+        """
+        while not self._closed:
+            try:
+                data = self.socket.recv(self.READ_SIZE)
+            except BlockingIOError:
+                break
+            if len(data) == 0:
+                # connection closed by qemu
+                self._closed = True
+                break
+            self._buffer += data
+        self._dispatch()
+
+    def _process(self, timeout):
+        """
+        Wait for data up to timeout seconds and dispatch received messages
+        """
+        if self._closed:
+            raise RuntimeError(f'QMP connection closed : {self.qmp_file}')
+        if self._selector.select(timeout):
+            self.read_available()
+
+    def _dispatch(self):
+        while b'\n' in self._buffer:
+            line, self._buffer = self._buffer.split(b'\n', 1)
+            if len(line.strip()) == 0:
+                continue
+            msg = json.loads(line)
+            if 'QMP' in msg:
+                self.greeting = msg
+            elif 'event' in msg:
+                msg['recv_time'] = time.perf_counter()
+                self.events.append(msg)
+                for callback in self._callbacks.get(msg['event'], []) + self._callbacks.get(None, []):
+                    callback(msg)
+            elif 'id' in msg:
+                self._responses[msg['id']] = msg
+
+    def send(self, cmd, args=None):
+        """
+        Send a command without waiting for its response
+        Returns the command id to be used with result()
+        """
+        cmd_id = self._next_id
+        self._next_id += 1
+        msg = {'execute': cmd, 'id': cmd_id}
+        if args is not None:
+            msg['arguments'] = args
+        self.socket.sendall(json.dumps(msg).encode('utf-8') + b'\n')
+        return cmd_id
+
+    def result(self, cmd_id, timeout=COMMAND_TIMEOUT):
+        """
+        Wait for the response of a command previously sent
+        Returns the 'return' value of the response
+        """
+        deadline = time.monotonic() + timeout
+        while cmd_id not in self._responses:
+            self._process(self._remaining(deadline))
+        response = self._responses.pop(cmd_id)
+        if 'error' in response:
+            raise RuntimeError(f'QMP command failed : {response["error"]}')
+        return response['return']
+
+    def command(self, cmd, args=None, timeout=COMMAND_TIMEOUT):
+        """
+        Send a command and wait for its response
+        """
+        return self.result(self.send(cmd, args), timeout=timeout)
+
+    def subscribe(self, callback, event=None):
+        """
+        Call callback(event_msg) on each received event named event
+        (on all events if event is None)
+        """
+        self._callbacks.setdefault(event, []).append(callback)
+
+    def wait_event(self, events, timeout=CONNECT_TIMEOUT, start=0):
+        """
+        Wait for one of the events (list of names) received after
+        the start-th event
+        Returns the event message
+        """
+        deadline = time.monotonic() + timeout
+        index = start
+        while True:
+            for msg in self.events[index:]:
+                if msg['event'] in events:
+                    return msg
+            index = len(self.events)
+            try:
+                self._process(self._remaining(deadline))
+            except TimeoutError:
+                raise RuntimeError(f'Wait for events {events} failed')
+
+    def wait_for_state(self, s, timeout=CONNECT_TIMEOUT):
+        """
+        Wait until the VM run state (query-status) is s
+        The status is re-checked on every run state event, so the
+        wait ends as soon as qemu notifies the change
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            start = len(self.events)
+            if self.command('query-status')['status'] == s:
+                return True
+            try:
+                self.wait_event(self.STATE_EVENTS, timeout=self._remaining(deadline), start=start)
+            except (RuntimeError, TimeoutError):
+                raise RuntimeError('Check state failed : %s' % (s))
+
+    def wait_job(self, job_id, timeout=CONNECT_TIMEOUT, start=0):
+        """
+        Wait for the completion of a job (ex: snapshot-save) whose
+        events have been received after the start-th event, then dismiss it
+        Raise RuntimeError if the job failed
+        """
+        deadline = time.monotonic() + timeout
+        index = start
+        while True:
+            for msg in self.events[index:]:
+                index += 1
+                if msg['event'] != 'JOB_STATUS_CHANGE' or msg['data']['id'] != job_id:
+                    continue
+                if msg['data']['status'] == 'concluded':
+                    errors = [j.get('error') for j in self.command('query-jobs') if j['id'] == job_id]
+                    self.command('job-dismiss', {'id': job_id})
+                    if len(errors) > 0 and errors[0] is not None:
+                        raise RuntimeError(f'QMP job {job_id} failed : {errors[0]}')
+                    return
+            try:
+                self._process(self._remaining(deadline))
+            except TimeoutError:
+                raise RuntimeError(f'QMP job {job_id} timeout')
+
+    def wakeup(self):
+        self.command('system_wakeup')
+
+    def powerdown(self):
+        self.command('system_powerdown')
+
+    def __del__(self):
+        if getattr(self, 'socket', None) is not None:
+            self.socket.close()
+
+class QemuQmpSelector():
+    """
+    Monitor the QMP connections of many QEMU machines from a single
+    selector loop
+
+    Example:
+      sel = QemuQmpSelector([QemuQmp(qm) for qm in machines])
+      sel.wait_event('SHUTDOWN', timeout=60)
+    """
+    def __init__(self, clients=[]):
+        self._selector = selectors.DefaultSelector()
+        self.clients = []
+        for c in clients:
+            self.add(c)
+
+    def add(self, client):
+        self._selector.register(client.socket, selectors.EVENT_READ, client)
+        self.clients.append(client)
+
+    def poll(self, timeout=None):
+        """
+        Dispatch the data available on all connections,
+        wait up to timeout seconds if no data is available
+        """
+        for key, _ in self._selector.select(timeout):
+            key.data.read_available()
+            if key.data.closed:
+                self._selector.unregister(key.fileobj)
+
+    def wait_event(self, event, timeout=QemuQmp.CONNECT_TIMEOUT):
+        """
+        Wait until all clients have received the event (name)
+        """
+        deadline = time.monotonic() + timeout
+        def pending():
+            return [c for c in self.clients
+                    if not any(e['event'] == event for e in c.events)]
+        while len(pending()) > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError(f'Wait for event {event} failed on {len(pending())} machines')
+            self.poll(remaining)
+        return True
+
+class QemuGuestReadiness():
+    """
+    Follow the serial log of the guest and record boot milestones
+
+    The serial log written by QemuSerial is read incrementally (only the
+    new data is read on each poll) and each line is matched against the
+    milestone patterns. The first match of each milestone is timestamped
+    (time.perf_counter()).
+
+    Milestones are a list of (name, regex) and can be customized per machine:
+      qm.readiness_milestones = QemuGuestReadiness.DEFAULT_MILESTONES + [('login', r'login: ')]
+    """
+    POLL_INTERVAL = 0.05
+    DEFAULT_MILESTONES = [
+        # OVMF/TDVF hands off to the boot loader
+        ('firmware', r'BdsDxe: (loading|starting) Boot'),
+        # kernel banner
+        ('kernel', r'Linux version \d'),
+        # systemd banner
+        ('systemd', r'Welcome to '),
+        # systemd reached its default target
+        ('target', r'Reached target .*(Multi-User System|Graphical Interface)'),
+        # ssh service or ssh socket (socket activation) is up
+        ('sshd', r'(Started|Listening on) .*(OpenBSD Secure Shell|ssh\.service|ssh\.socket)'),
+    ]
+
+    def __init__(self, serial_file, milestones=DEFAULT_MILESTONES, start_time=None):
+        self.serial_file = serial_file
+        self.milestones = [(name, re.compile(regex)) for name, regex in milestones]
+        if start_time is None:
+            start_time = time.perf_counter()
+        self.start_time = start_time
+        # milestone name -> time.perf_counter() of its first occurrence
+        self.timestamps = {}
+        self._offset = 0
+        self._partial = b''
+
+    def poll(self):
+        """
+        Read the data appended to the serial log since the last poll
+        and record the milestones found
+        """
+        try:
+            with open(self.serial_file, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < self._offset:
+                    # file has been truncated (new qemu run)
+                    self._offset = 0
+                    self._partial = b''
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if len(data) == 0:
+            return
+        now = time.perf_counter()
+        self._offset += len(data)
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            text = line.decode('utf-8', errors='replace')
+            for name, regex in self.milestones:
+                if name not in self.timestamps and regex.search(text):
+                    self.timestamps[name] = now
+
+    def reached(self, milestone):
+        return milestone in self.timestamps
+
+    def wait(self, milestone='sshd', timeout=60, proc=None):
+        """
+        Wait for a milestone
+        Returns True if the milestone has been reached, False on timeout
+        or if the qemu process (proc) exits
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            self.poll()
+            if self.reached(milestone):
+                return True
+            if proc is not None and proc.poll() is not None:
+                return False
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.POLL_INTERVAL)
+
+    def elapsed(self):
+        """
+        Returns the time (seconds) of each reached milestone since start time
+        """
+        return {name: t - self.start_time for name, t in self.timestamps.items()}
+
+class QemuSSHResult():
+    """
+    Result of a command executed by QemuSSH.exec_batch
+    """
+    def __init__(self, cmd, ret, stdout, stderr, latency):
+        self.cmd = cmd
+        self.ret = ret
+        self.stdout = stdout
+        self.stderr = stderr
+        # time between the command submission and its exit (seconds)
+        self.latency = latency
+
+    def __repr__(self):
+        return f'QemuSSHResult(cmd={self.cmd!r}, ret={self.ret}, latency={self.latency:.4f})'
+
+class QemuSync():
+    """
+    Synchronize a local file or folder to the guest over an existing
+    SSH connection (QemuSSH), without forking rsync/ssh processes
+
+    A manifest (relative path -> size, mtime, sha256) of the synchronized
+    files and folders is stored in the destination folder of the guest.
+    On each sync, the manifest of the guest is read back (SFTP) and the
+    files of the guest folder are listed (one find command), the files
+    that are new or modified locally, or missing or modified (size, mtime)
+    in the guest are sent, packed in a single tar stream (optionally gzip
+    compressed) extracted by one remote command. Files and folders removed
+    locally since the previous sync are deleted in the guest.
+    File hashes are cached by (path, size, mtime) so syncing the same tree
+    to many guests only hashes it once.
+    """
+    MANIFEST = '.tdxtest-sync-manifest.json'
+    DEFAULT_EXCLUDES = ['*~']
+    # digest of the folder entries of the manifest
+    DIR = 'dir'
+
+    # (path, size, mtime_ns) -> sha256 hex digest
+    _hash_cache = {}
+    _hash_cache_lock = threading.Lock()
+
+    def __init__(self, ssh, excludes=DEFAULT_EXCLUDES, compress=False):
+        self.ssh = ssh
+        self.excludes = excludes
+        self.compress = compress
+
+    @staticmethod
+    def _file_hash(path, st):
+        key = (path, st.st_size, st.st_mtime_ns)
+        with QemuSync._hash_cache_lock:
+            if key in QemuSync._hash_cache:
+                return QemuSync._hash_cache[key]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        with QemuSync._hash_cache_lock:
+            QemuSync._hash_cache[key] = h.hexdigest()
+        return h.hexdigest()
+
+    def _excluded(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.excludes)
+
+    def _entry(self, path):
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            digest = 'link:' + os.readlink(path)
+        elif stat.S_ISDIR(st.st_mode):
+            return [0, st.st_mtime_ns, self.DIR]
+        else:
+            digest = self._file_hash(path, st)
+        return [st.st_size, st.st_mtime_ns, digest]
+
+    @staticmethod
+    def _file_type(mode):
+        # file type letter of find -printf %y
+        if stat.S_ISDIR(mode):
+            return 'd'
+        if stat.S_ISLNK(mode):
+            return 'l'
+        return 'f'
+
+    def _up_to_date(self, entry, remote_file):
+        """
+        Whether the guest file (type, size, mtime) is the one of the manifest entry
+        """
+        if remote_file is None:
+            return False
+        file_type, size, mtime = remote_file
+        if entry[2] == self.DIR:
+            return file_type == 'd'
+        if entry[2].startswith('link:'):
+            return file_type == 'l'
+        # tar keeps the mtime with a precision of 1s
+        return file_type == 'f' and size == entry[0] and abs(mtime - entry[1] / 1e9) < 1
+
+    def local_manifest(self, src):
+        """
+        Manifest of the local folder src : {relative path: [size, mtime_ns, sha256]}
+        Folders are in the manifest with the digest DIR
+        """
+        manifest = {}
+        for root, dirs, files in os.walk(src):
+            dirs[:] = sorted(d for d in dirs if not self._excluded(d))
+            for name in dirs + sorted(files):
+                if self._excluded(name):
+                    continue
+                path = os.path.join(root, name)
+                manifest[os.path.relpath(path, src)] = self._entry(path)
+        return manifest
+
+    def remote_manifest(self, target):
+        try:
+            with self.ssh.sftp.open(f'{target}/{self.MANIFEST}') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def remote_files(self, target, sudo=False):
+        """
+        Files of the guest folder target : {relative path: (type, size, mtime)}
+        """
+        prefix = 'sudo ' if sudo else ''
+        _, stdout, _ = self.ssh.ssh_conn.exec_command(
+            f"{prefix}find {shlex.quote(target)} -mindepth 1 -printf '%P\\0%y\\0%s\\0%T@\\0'")
+        fields = stdout.read().split(b'\0')[:-1]
+        stdout.channel.recv_exit_status()
+        files = {}
+        for i in range(0, len(fields) - 3, 4):
+            files[fields[i].decode('utf-8', errors='surrogateescape')] = \
+                (fields[i + 1].decode(), int(fields[i + 2]), float(fields[i + 3]))
+        return files
+
+    def sync(self, src, dest, sudo=False):
+        """
+        Same destination as rsync : if src is a folder ending with '/', the
+        content of src is copied into dest, otherwise src is copied into
+        dest/basename(src)
+        A single file is sent if the guest file differs in size or mtime
+        (no manifest), a folder is synchronized with its manifest
+        Returns the list of transferred files
+        """
+        if not os.path.isdir(src) or os.path.islink(src):
+            return self._sync_file(src, dest, sudo)
+
+        if src.endswith('/'):
+            target = dest
+        else:
+            target = os.path.join(dest, os.path.basename(src))
+        remote = self.remote_manifest(target)
+        local = self.local_manifest(src)
+        remote_files = self.remote_files(target, sudo) if len(remote) > 0 else {}
+
+        changed = [f for f, entry in local.items()
+                   if f not in remote or remote[f][2] != entry[2]
+                   or not self._up_to_date(remote[f], remote_files.get(f))]
+        deleted = [f for f in remote if f not in local]
+        if len(changed) == 0 and len(deleted) == 0:
+            return []
+
+        # the unchanged files keep the size and mtime they have in the guest
+        manifest = {f: entry if f in changed else remote[f] for f, entry in local.items()}
+        self._send(src, changed, target, sudo, manifest=manifest, deleted=deleted)
+        return [f for f in changed if local[f][2] != self.DIR]
+
+    def _sync_file(self, src, dest, sudo):
+        name = os.path.basename(src)
+        entry = self._entry(src)
+        path = f'{dest}/{name}'
+        try:
+            st = self.ssh.sftp.lstat(path)
+            remote_file = (self._file_type(st.st_mode), st.st_size, st.st_mtime)
+            if remote_file[0] == 'l' and entry[2] != 'link:' + self.ssh.sftp.readlink(path):
+                remote_file = None
+        except IOError:
+            remote_file = None
+        if self._up_to_date(entry, remote_file):
+            return []
+        self._send(os.path.dirname(os.path.abspath(src)), [name], dest, sudo)
+        return [name]
+
+    def _send(self, local_root, files, target, sudo, manifest=None, deleted=()):
+        """
+        Extract the files (relative to local_root) and the manifest in the
+        guest folder target and remove the deleted files, in one command
+        """
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz' if self.compress else 'w') as tar:
+            for f in files:
+                tar.add(os.path.join(local_root, f), arcname=f, recursive=False)
+            if manifest is not None:
+                data = json.dumps(manifest).encode('utf-8')
+                info = tarfile.TarInfo(self.MANIFEST)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+
+        prefix = 'sudo ' if sudo else ''
+        cmd = f'{prefix}mkdir -p {shlex.quote(target)} && ' \
+              f'{prefix}tar -x{"z" if self.compress else ""}f - -C {shlex.quote(target)}'
+        if len(deleted) > 0:
+            cmd += f' && cd {shlex.quote(target)} && {prefix}rm -rf -- ' + \
+                ' '.join(shlex.quote(f) for f in deleted)
+        chan = self.ssh.ssh_conn.get_transport().open_session()
+        chan.exec_command(cmd)
+        chan.sendall(buf.getvalue())
+        chan.shutdown_write()
+        ret = chan.recv_exit_status()
+        err = chan.makefile_stderr('rb').read().decode('utf-8', errors='replace')
+        chan.close()
+        assert ret == 0, f'Sync of {local_root} to {target} failed : {err}'
+
 class QemuSSH():
     CONNECT_SLEEP = 1
     CONNECT_TIMEOUT = 60
+    KEEPALIVE_INTERVAL = 30
+    # sshd accepts 10 sessions per connection by default (MaxSessions)
+    MAX_CHANNELS = 8
+    BATCH_POLL_INTERVAL = 0.05
+    READ_SIZE = 65536
 
     def __init__(self,
                  qemu_machine,
-                 timeout=CONNECT_TIMEOUT):
+                 timeout=CONNECT_TIMEOUT,
+                 wait_serial=True):
         assert qemu_machine.fwd_port != None
 
         self.username = 'root'
@@ -399,9 +1028,22 @@ class QemuSSH():
         # prevent paramiko to do spurious logs on stdout
         paramiko.util.log_to_file(filename=f'{qemu_machine.workdir_name}/paramiko-log.txt', level=logging.DEBUG)
 
-        self._wait_and_connect(qemu_machine.fwd_port, timeout=timeout)
-
-    def _wait_and_connect(self, port, timeout=CONNECT_TIMEOUT):
+        # retry the connection as soon as the guest announces on the serial
+        # console that sshd is up (the console can be quiet, the connection
+        # is retried anyway until timeout)
+        readiness = getattr(qemu_machine, 'readiness', None) if wait_serial else None
+
+        self._wait_and_connect(qemu_machine.fwd_port, timeout=timeout, readiness=readiness)
+        if readiness is not None:
+            readiness.poll()
+            print(f'Boot milestones : {readiness.elapsed()}')
+        self.ssh_conn.get_transport().set_keepalive(self.KEEPALIVE_INTERVAL)
+        # persistent SFTP session, opened on first use
+        self._sftp = None
+        # (command, latency in seconds) of all executed commands
+        self.latencies = []
+
+    def _wait_and_connect(self, port, timeout=CONNECT_TIMEOUT, readiness=None):
         self.ssh_conn = paramiko.SSHClient()
         self.ssh_conn.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.ssh_conn.load_system_host_keys()
@@ -429,40 +1071,38 @@ class QemuSSH():
             if (time.time() >= (timeout_start + timeout)):
                 print('Connexion timeout !')
                 self.ssh_conn = None
+            elif readiness is not None and not readiness.reached('sshd'):
+                # next attempt after CONNECT_SLEEP or once sshd is announced
+                readiness.wait('sshd', timeout=self.CONNECT_SLEEP)
             else:
                 time.sleep(self.CONNECT_SLEEP)
         assert self.ssh_conn != None
         print('Connected ...')
         return self.ssh_conn
 
+    @property
+    def sftp(self):
+        """
+        SFTP client, the session is kept open and reused
+        """
+        if self._sftp is None or self._sftp.get_channel().closed:
+            self._sftp = self.ssh_conn.open_sftp()
+        return self._sftp
+
     def put(self, local_file, remote_file):
-        ftp_client=self.ssh_conn.open_sftp()
-        ftp_client.put(local_file, remote_file)
-        ftp_client.close()
+        self.sftp.put(local_file, remote_file)
 
     def get(self, remote_file, local_file):
-        ftp_client=self.ssh_conn.open_sftp()
-        ftp_client.get(remote_file, local_file)
-        ftp_client.close()
+        self.sftp.get(remote_file, local_file)
 
-    def rsync_file(self, fname, dest, sudo=False):
+    def rsync_file(self, fname, dest, sudo=False, compress=False,
+                   excludes=QemuSync.DEFAULT_EXCLUDES):
         """
         fname : local file or folder
         dest : destination folder (parent folder)
+        Files are transferred over the SSH connection (see QemuSync)
         """
-        kv_user=self.username
-        kv_pass=self.password
-        kv_host='127.0.0.1'
-        kv_port=self.port
-        ssh_opts=f'-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -p {kv_port}'
-        rsync_opts='-atrv --delete --exclude="*~"'
-        # use sshpass to pass clear text password for ssh
-        rsync_opts += f' -e "sshpass -p {kv_pass} ssh {ssh_opts}"'
-        if sudo:
-            rsync_opts += ' --rsync-path="sudo rsync"'
-        subprocess.check_call(f'rsync {rsync_opts}  {fname} {kv_user}@{kv_host}:{dest}',
-                              shell=True,
-                              stdout=subprocess.DEVNULL)
+        return QemuSync(self, excludes=excludes, compress=compress).sync(fname, dest, sudo=sudo)
 
     def exec_command(self, cmd):
         """
@@ -472,8 +1112,10 @@ class QemuSSH():
         - stdout
         - stderr
         """
+        start = time.perf_counter()
         _, stdout, stderr = self.ssh_conn.exec_command(cmd)
         ret_status = stdout.channel.recv_exit_status()
+        self.latencies.append((cmd, time.perf_counter() - start))
         return ret_status, stdout, stderr
 
     def check_exec(self, cmd, err_msg=None):
@@ -483,18 +1125,192 @@ class QemuSSH():
         - stdout
         - stderr
         """
+        start = time.perf_counter()
         _, stdout, stderr = self.ssh_conn.exec_command(cmd)
         if err_msg==None:
             err_msg=f'Execution of {cmd} failed'
         ret_status = stdout.channel.recv_exit_status()
+        self.latencies.append((cmd, time.perf_counter() - start))
         if ret_status != 0:
             print(stderr.read().decode('utf-8'))
         assert (0 == ret_status), err_msg
         return stdout, stderr
 
+    def exec_batch(self, cmds, max_parallel=MAX_CHANNELS, on_output=None):
+        """
+        Run several commands in parallel over the SSH connection
+        (one channel per command, up to max_parallel channels at a time)
+        on_output(index, stream, data) is called as soon as output is
+        received, stream is 'stdout' or 'stderr'
+        Returns the list of QemuSSHResult (same order as cmds)
+        """
+        transport = self.ssh_conn.get_transport()
+        results = [None] * len(cmds)
+        pending = list(enumerate(cmds))
+        # channel -> [index, start time, stdout chunks, stderr chunks]
+        running = {}
+
+        def read(chan, entry, drain=False):
+            while chan.recv_ready() or (drain and not chan.eof_received):
+                data = chan.recv(self.READ_SIZE)
+                if len(data) == 0:
+                    break
+                entry[2].append(data)
+                if on_output:
+                    on_output(entry[0], 'stdout', data)
+            while chan.recv_stderr_ready():
+                data = chan.recv_stderr(self.READ_SIZE)
+                entry[3].append(data)
+                if on_output:
+                    on_output(entry[0], 'stderr', data)
+
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < max_parallel:
+                index, cmd = pending.pop(0)
+                chan = transport.open_session()
+                chan.exec_command(cmd)
+                running[chan] = [index, time.perf_counter(), [], []]
+            # channels are readable when stdout data is available, stderr data
+            # and exit status are not notified, so also wake up periodically
+            select.select(list(running), [], [], self.BATCH_POLL_INTERVAL)
+            for chan in list(running):
+                entry = running[chan]
+                read(chan, entry)
+                if not chan.exit_status_ready():
+                    continue
+                read(chan, entry, drain=True)
+                ret = chan.recv_exit_status()
+                latency = time.perf_counter() - entry[1]
+                cmd = cmds[entry[0]]
+                results[entry[0]] = QemuSSHResult(cmd, ret,
+                                                  b''.join(entry[2]).decode('utf-8', errors='replace'),
+                                                  b''.join(entry[3]).decode('utf-8', errors='replace'),
+                                                  latency)
+                self.latencies.append((cmd, latency))
+                chan.close()
+                del running[chan]
+        return results
+
+    def print_latencies(self):
+        """
+        Print the latency of the executed commands
+        """
+        for cmd, latency in self.latencies:
+            print(f'{latency:8.4f}s : {cmd}')
+
     def poweroff(self):
         _, stdout, _ = self.ssh_conn.exec_command('poweroff')
 
+class QemuOverlayPool:
+    """
+    Pool of pre-created qcow2 overlay images backed by the same image
+
+    An empty overlay does not depend on its own path, so qemu-img is only
+    run once to create a template overlay, the overlays are then plain
+    copies of this template. A few overlays are copied in advance in the
+    background, handing out an overlay is a simple rename.
+    The template is invalidated (and re-created) when the backing image
+    is modified (mtime or size change).
+
+    Example:
+      QemuOverlayPool.get('/var/tmp/tdxtest/tdx-guest.qcow2').acquire('/tmp/image.qcow2')
+    """
+    POOL_SIZE = 8
+
+    # backing image -> overlay pool
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    @staticmethod
+    def get(backing_file):
+        """
+        Returns the overlay pool of the backing image
+        """
+        with QemuOverlayPool._pools_lock:
+            if backing_file not in QemuOverlayPool._pools:
+                QemuOverlayPool._pools[backing_file] = QemuOverlayPool(backing_file)
+            return QemuOverlayPool._pools[backing_file]
+
+    def __init__(self, backing_file, size=POOL_SIZE):
+        self.backing_file = backing_file
+        self.size = size
+        self.dir = tempfile.mkdtemp(prefix='tdxtest-overlays-')
+        self._lock = threading.Lock()
+        self._signature = None
+        self._template = None
+        self._overlays = []
+        self._next = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        atexit.register(self.cleanup)
+
+    def _backing_signature(self):
+        st = os.stat(self.backing_file)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _new_path(self):
+        self._next += 1
+        return f'{self.dir}/overlay-{self._next}.qcow2'
+
+    def _check_template(self):
+        """
+        (Re)create the template if the backing image has changed
+        Must be called with the lock held
+        """
+        signature = self._backing_signature()
+        if signature == self._signature:
+            return
+        # stale overlays : drop them
+        for overlay in self._overlays:
+            pathlib.Path(overlay).unlink(missing_ok=True)
+        self._overlays = []
+        template = self._new_path()
+        subprocess.check_call(['qemu-img', 'create', '-f', 'qcow2',
+                               '-b', self.backing_file, '-F', 'qcow2', template],
+                              stdout=subprocess.DEVNULL)
+        if self._template is not None:
+            pathlib.Path(self._template).unlink(missing_ok=True)
+        self._template = template
+        self._signature = signature
+
+    def _refill(self):
+        while True:
+            with self._lock:
+                if len(self._overlays) >= self.size or self._template is None:
+                    return
+                template, signature, overlay = self._template, self._signature, self._new_path()
+            shutil.copyfile(template, overlay)
+            with self._lock:
+                if signature == self._signature:
+                    self._overlays.append(overlay)
+                else:
+                    pathlib.Path(overlay).unlink(missing_ok=True)
+
+    def acquire(self, dest):
+        """
+        Put a fresh overlay at dest
+        If dest already exists (ex: overlay re-creation), it is replaced
+        """
+        with self._lock:
+            self._check_template()
+            overlay = self._overlays.pop() if len(self._overlays) > 0 else None
+            handed_out = False
+            if overlay is not None:
+                try:
+                    os.replace(overlay, dest)
+                    handed_out = True
+                except OSError:
+                    # not on the same filesystem
+                    pathlib.Path(overlay).unlink(missing_ok=True)
+            if not handed_out:
+                # pool is empty, copy the template (truncates dest if it exists)
+                shutil.copyfile(self._template, dest)
+        self._executor.submit(self._refill)
+        return dest
+
+    def cleanup(self):
+        self._executor.shutdown(wait=True)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
 class QemuMachineService:
     QEMU_MACHINE_PORT_FWD = enum.auto()
     QEMU_MACHINE_MONITOR = enum.auto()
@@ -517,12 +1333,28 @@ class QemuMachine:
                  name='default',
                  machine=QemuEfiMachine.OVMF_Q35_TDX,
                  memory='2G',
-                 service_blacklist=[]):
+                 service_blacklist=[],
+                 image=None,
+                 base_image=None,
+                 telemetry=False):
+        """
+        image : qcow2 image used as is instead of an overlay of the guest
+                image, the guest writes to it
+        base_image : image used as backing file of the overlay
+                     (default : TDXTEST_GUEST_IMG)
+        telemetry : add the QMP socket of the telemetry sampler
+                    (see telemetry.QemuTelemetry)
+        """
         self.name = name
         self.image_dir = '/var/tmp/tdxtest/'
-        self.guest_initial_img = os.environ.get('TDXTEST_GUEST_IMG', f'{self.image_dir}/tdx-guest.qcow2')
+        self.guest_initial_img = base_image
+        if self.guest_initial_img is None:
+            self.guest_initial_img = QemuMachine.default_guest_image()
         self._setup_workdir()
-        self._create_image()
+        if image is None:
+            self._create_image()
+        else:
+            self.image_path = image
 
         # TODO : WA for log, to be removed
         print(f'\n\nQemuMachine created.')
@@ -539,11 +1371,23 @@ class QemuMachine:
         # of this client instance in the qemu machine object
         self.monitor = None
         self.qcmd.add_qmp()
+        # qmp client associated to this machine (same constraint as monitor)
+        self.qmp = None
+        # QMP socket for the telemetry sampler (see telemetry.QemuTelemetry)
+        self.telemetry_qmp_file = None
+        if telemetry:
+            self.telemetry_qmp_file = self.qcmd.add_qmp_socket('qmp-telemetry')
         if QemuMachineService.QEMU_MACHINE_PORT_FWD not in service_blacklist:
             self.fwd_port = util.tcp_port_available()
             self.qcmd.add_port_forward(self.fwd_port)
         self.qcmd.add_qemu_run_log()
 
+        # boot milestones detection on the serial log
+        self.readiness_milestones = QemuGuestReadiness.DEFAULT_MILESTONES
+        self.readiness = None
+        # tag of the snapshot to restore (see snapshot())
+        self.snapshot_tag = None
+
         self.proc = None
         self.out = None
         self.err = None
@@ -558,6 +1402,10 @@ class QemuMachine:
     def set_debug(debug : bool):
         QemuMachine.debug_enabled = debug
 
+    @staticmethod
+    def default_guest_image():
+        return os.environ.get('TDXTEST_GUEST_IMG', '/var/tmp/tdxtest/tdx-guest.qcow2')
+
     @staticmethod
     def stop_all_running_qemus():
         for qemu in QemuMachine.qemu_instances:
@@ -566,10 +1414,9 @@ class QemuMachine:
     def _create_image(self):
         # create an overlay image backed by the original image
         # See https://wiki.qemu.org/Documentation/CreateSnapshot
+        # overlays are pre-created by the overlay pool
         self.image_path=f'{self.workdir_name}/image.qcow2'
-        subprocess.check_call(f'qemu-img create -f qcow2 -b {self.guest_initial_img} -F qcow2 {self.image_path}',
-                              stdout=subprocess.DEVNULL,
-                              shell=True)
+        QemuOverlayPool.get(self.guest_initial_img).acquire(self.image_path)
 
     def _setup_workdir(self):
         # if /run/user/ user folder exists, use it to store the work dir
@@ -597,18 +1444,7 @@ class QemuMachine:
         fname : local file or folder
         dest : destination folder (parent folder)
         """
-        kv_user='root'
-        kv_host='127.0.0.1'
-        kv_port=self.fwd_port
-        ssh_opts=f'-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -p {kv_port}'
-        rsync_opts='-atrv --delete --exclude="*~"'
-        # use sshpass to pass clear text password for ssh
-        rsync_opts += f' -e "sshpass -p 123456 ssh {ssh_opts}"'
-        if sudo:
-            rsync_opts += ' --rsync-path="sudo rsync"'
-        subprocess.check_call(f'rsync {rsync_opts}  {fname} {kv_user}@{kv_host}:{dest}',
-                              shell=True,
-                              stdout=subprocess.DEVNULL)
+        return QemuSSH(self).rsync_file(fname, dest, sudo=sudo)
 
     def run(self):
         """
@@ -618,16 +1454,27 @@ class QemuMachine:
         print(' '.join(cmd))
         script=f'{self.workdir_name}/run.sh'
         self.write_cmd_to_file(script)
+        # a new qemu process needs a new qmp connection
+        self.qmp = None
+        self.readiness = self._create_readiness()
         self.proc = subprocess.Popen(cmd,
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.PIPE)
 
+    def _create_readiness(self):
+        serial_file = self.qcmd.plugins['serial'].serial_file
+        if serial_file is None:
+            return None
+        # remove the previous log to not match milestones of a previous run
+        pathlib.Path(serial_file).unlink(missing_ok=True)
+        return QemuGuestReadiness(serial_file, self.readiness_milestones)
+
     def run_and_wait(self):
         """
-        Run qemu and wait for its start (by waiting for monitor file's availability)
+        Run qemu and wait for its start (by waiting for QMP availability)
         """
         self.run()
-        QemuMonitor(self)
+        QemuQmp(self)
 
     def communicate(self, timeout=60):
         """
@@ -650,8 +1497,7 @@ class QemuMachine:
             return False
 
         try:
-            mon = QemuMonitor(self)
-            mon.powerdown()
+            QemuQmp(self).powerdown()
         except Exception as e:
             pass
 
@@ -681,6 +1527,77 @@ class QemuMachine:
         except Exception as e:
             print(f'Exception {e}')
 
+    def _disk_node_name(self, qmp):
+        for block in qmp.command('query-block'):
+            if block['device'] == 'virtio-disk0' and 'inserted' in block:
+                return block['inserted']['node-name']
+        raise RuntimeError('Cannot find the disk block node')
+
+    def can_snapshot(self):
+        """
+        The VM state of a TD cannot be saved (its private memory is
+        not accessible to the host)
+        """
+        return self.qcmd.plugins['machine'].machine != QemuEfiMachine.OVMF_Q35_TDX
+
+    def snapshot(self, tag='tdxtest', timeout=QemuQmp.CONNECT_TIMEOUT):
+        """
+        Save the VM state and the disk state as an internal qcow2 snapshot
+        Returns the snapshot duration in seconds, or None if the machine
+        does not support snapshots (restore() will then re-create the overlay)
+        """
+        self.snapshot_tag = None
+        if not self.can_snapshot():
+            print(f'Snapshot not supported, restore will re-create the overlay ({self.workdir_name})')
+            return None
+        start_time = time.perf_counter()
+        qmp = QemuQmp(self)
+        node = self._disk_node_name(qmp)
+        job_id = f'snapshot-save-{tag}'
+        start = len(qmp.events)
+        try:
+            qmp.command('snapshot-save', {'job-id': job_id, 'tag': tag,
+                                          'vmstate': node, 'devices': [node]})
+            qmp.wait_job(job_id, timeout=timeout, start=start)
+        except RuntimeError as e:
+            print(f'Snapshot failed, restore will re-create the overlay : {e}')
+            return None
+        self.snapshot_tag = tag
+        duration = time.perf_counter() - start_time
+        print(f'Snapshot {tag} saved in {duration:.2f} seconds')
+        return duration
+
+    def restore(self, timeout=QemuSSH.CONNECT_TIMEOUT):
+        """
+        Restore the state saved by snapshot()
+        If no snapshot is available, the VM is stopped, its overlay image
+        re-created and the VM is started again (ready when SSH is available)
+        Returns a dict with the restore method ('snapshot' or 'overlay')
+        and its duration in seconds
+        """
+        start_time = time.perf_counter()
+        tag = self.snapshot_tag
+        if tag is not None:
+            qmp = QemuQmp(self)
+            node = self._disk_node_name(qmp)
+            job_id = f'snapshot-load-{tag}'
+            start = len(qmp.events)
+            qmp.command('snapshot-load', {'job-id': job_id, 'tag': tag,
+                                          'vmstate': node, 'devices': [node]})
+            qmp.wait_job(job_id, timeout=timeout, start=start)
+            if qmp.command('query-status')['status'] != 'running':
+                qmp.command('cont')
+            method = 'snapshot'
+        else:
+            self.stop()
+            self._create_image()
+            self.run()
+            QemuSSH(self, timeout=timeout)
+            method = 'overlay'
+        result = {'method': method, 'duration': time.perf_counter() - start_time}
+        print(f'Restore ({method}) took {result["duration"]:.2f} seconds')
+        return result
+
     def reboot(self):
         """
         Reboot the QEMU machine
@@ -746,3 +1663,529 @@ class QemuMachine:
         useful if we want to avoid these cleanup actions (test failure, debug flag, ...)
         """
         self.stop()
+
+
+class QemuFleet:
+    """
+    Run a set of QEMU machines in parallel
+
+    All machines are started concurrently and the SSH connection is awaited
+    on all of them in parallel, so bringing up the fleet takes about as long
+    as the slowest boot instead of the sum of all boots.
+    max_parallel limits the number of machines booting at the same time
+    (default: no limit).
+
+    Example:
+      machines = [QemuMachine() for _ in range(8)]
+      with QemuFleet(machines) as fleet:
+          timings = fleet.run_and_wait()
+          fleet.ssh[0].check_exec('uname -a')
+    """
+    def __init__(self, machines, max_parallel=None):
+        self.machines = list(machines)
+        if max_parallel is None:
+            max_parallel = len(self.machines)
+        self.max_parallel = max(1, max_parallel)
+        # SSH client of each machine (same index as machines)
+        self.ssh = [None] * len(self.machines)
+        # readiness timings of each machine (same index as machines)
+        self.timings = [None] * len(self.machines)
+
+    def _run_one(self, index, fleet_start, timeout):
+        qm = self.machines[index]
+        launch = time.perf_counter()
+        qm.run()
+        self.ssh[index] = QemuSSH(qm, timeout=timeout)
+        ready = time.perf_counter()
+        self.timings[index] = {
+            'name': qm.name,
+            'workdir': qm.workdir_name,
+            # time between the fleet start and the launch of qemu
+            'launch': launch - fleet_start,
+            # time between the launch of qemu and the ssh availability
+            'boot': ready - launch,
+            # time between the fleet start and the ssh availability
+            'ready': ready - fleet_start,
+        }
+        return self.timings[index]
+
+    def run_and_wait(self, timeout=QemuSSH.CONNECT_TIMEOUT):
+        """
+        Run all machines and wait until SSH is available on all of them
+        Returns the list of per-machine timings (in seconds)
+        Raise the first error encountered after all machines have been processed
+        """
+        fleet_start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            futures = [executor.submit(self._run_one, i, fleet_start, timeout)
+                       for i in range(len(self.machines))]
+            concurrent.futures.wait(futures)
+        total = time.perf_counter() - fleet_start
+
+        errors = [(i, f.exception()) for i, f in enumerate(futures) if f.exception() is not None]
+        for i, err in errors:
+            print(f'Machine {i} ({self.machines[i].workdir_name}) failed : {err!r}')
+        if len(errors) > 0:
+            raise errors[0][1]
+
+        slowest = max((t['boot'] for t in self.timings), default=0)
+        print(f'Fleet of {len(self.machines)} machines ready in {total:.2f} seconds'
+              f' (slowest boot : {slowest:.2f} seconds)')
+        return self.timings
+
+    def _parallel_map(self, func):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.machines))) as executor:
+            return list(executor.map(func, self.machines))
+
+    def shutdown(self):
+        """
+        Send shutdown command to all machines, do not wait for them to exit
+        """
+        self._parallel_map(lambda qm: qm.shutdown())
+
+    def stop(self):
+        """
+        Stop all machines in parallel
+        """
+        self._parallel_map(lambda qm: qm.stop())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class QemuMachinePool:
+    """
+    Pool of booted QEMU machines ready to be leased
+
+    The pool boots size machines (SSH available) in the background when
+    it is created and is refilled in the background on lease and release,
+    so that size machines are ready or booting. A leased machine is never
+    reused: on release it is stopped and its overlay image discarded.
+    drain() stops the machines of the pool and suspends the refill until
+    the next lease (tests that need the whole host).
+    Only tests that do not modify the machine configuration should use
+    leased machines.
+
+    Example:
+      pool = QemuMachinePool(2)
+      qm = pool.lease()
+      ssh = QemuSSH(qm)
+      pool.release(qm)
+      pool.close()
+    """
+    LEASE_TIMEOUT = 300
+    # consecutive boot failures before lease() reports the boot error
+    MAX_BOOT_RETRIES = 2
+
+    def __init__(self,
+                 size,
+                 machine=QemuEfiMachine.OVMF_Q35_TDX,
+                 memory='2G',
+                 timeout=QemuSSH.CONNECT_TIMEOUT,
+                 base_image=None):
+        self.size = size
+        self.machine = machine
+        self.memory = memory
+        # backing image of the machines (see QemuMachine)
+        self.base_image = base_image
+        self.timeout = timeout
+        # booted machines, or the boot error once the retries are exhausted
+        self._ready = queue.Queue()
+        self._closed = False
+        # the done callback of a future can run in the submitting thread
+        self._lock = threading.RLock()
+        self._booting = set()
+        self._waiters = 0
+        self._boot_failures = 0
+        # no refill between drain() and the next lease()
+        self._suspended = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, size))
+        self._refill()
+
+    def _boot(self):
+        qm = QemuMachine('pool', self.machine, self.memory, base_image=self.base_image)
+        qm.run()
+        QemuSSH(qm, timeout=self.timeout)
+        return qm
+
+    def _on_booted(self, future):
+        with self._lock:
+            self._booting.discard(future)
+            error = future.exception()
+            if error is not None:
+                print(f'Pool machine failed to boot : {error!r}')
+                self._boot_failures += 1
+                if self._boot_failures > self.MAX_BOOT_RETRIES:
+                    # wake up a waiter with the error
+                    self._ready.put(error)
+                else:
+                    self._refill()
+                return
+            self._boot_failures = 0
+            qm = future.result()
+            if not self._closed:
+                self._ready.put(qm)
+                return
+        qm.stop()
+
+    def _refill(self):
+        """
+        Boot machines until size machines (or one per waiter) are ready or booting
+        """
+        with self._lock:
+            if self._closed or self._suspended:
+                return
+            while self._ready.qsize() + len(self._booting) < max(self.size, self._waiters):
+                future = self._executor.submit(self._boot)
+                self._booting.add(future)
+                future.add_done_callback(self._on_booted)
+
+    def lease(self, timeout=LEASE_TIMEOUT):
+        """
+        Get a booted machine from the pool (wait up to timeout seconds)
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('The pool is closed')
+            self._waiters += 1
+            self._suspended = False
+        try:
+            while True:
+                # boot a machine if none is ready or booting for this caller
+                self._refill()
+                try:
+                    qm = self._ready.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    raise RuntimeError(f'No machine available in the pool after {timeout}s')
+                if isinstance(qm, Exception):
+                    raise RuntimeError('Pool machine failed to boot') from qm
+                if qm.proc.poll() is None:
+                    return qm
+                # the machine has been stopped while in the pool (see release_kvm_use)
+        finally:
+            with self._lock:
+                self._waiters -= 1
+            # replace the leased machine
+            self._refill()
+
+    def release(self, qm):
+        """
+        Give back a leased machine, it is discarded
+        """
+        self._executor.submit(qm.stop)
+        self._refill()
+
+    def drain(self):
+        """
+        Wait for the machines being booted and stop all the machines of
+        the pool, the pool is refilled on the next lease
+        """
+        with self._lock:
+            self._suspended = True
+            booting = list(self._booting)
+        concurrent.futures.wait(booting)
+        while True:
+            try:
+                qm = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            if not isinstance(qm, Exception):
+                qm.stop()
+
+    def close(self):
+        """
+        Stop all the machines of the pool
+        """
+        with self._lock:
+            self._closed = True
+        self.drain()
+        self._executor.shutdown(wait=True)
+
+class QemuQmpAsync():
+    """
+    asyncio counterpart of QemuQmp
+    Responses and events are dispatched by a reader task, so any number
+    of machines can be monitored from the same event loop.
+    """
+    def __init__(self, qmp_file):
+        self.qmp_file = qmp_file
+        self.greeting = None
+        self.events = []
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._next_id = 0
+        self._responses = {}
+        self._events_cond = None
+
+    async def connect(self, proc=None, timeout=QemuQmp.CONNECT_TIMEOUT):
+        """
+        Connect to the QMP socket and enter command mode
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.qmp_file)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                pass
+            if proc is not None and proc.returncode is not None:
+                raise RuntimeError(f'QEMU exited before QMP connection : {self.qmp_file}')
+            if loop.time() >= deadline:
+                raise RuntimeError(f'QMP connection timeout : {self.qmp_file}')
+            await asyncio.sleep(QemuQmp.CONNECT_RETRY_SLEEP)
+        self._events_cond = asyncio.Condition()
+        line = await asyncio.wait_for(self._reader.readline(), deadline - loop.time())
+        self.greeting = json.loads(line)
+        self._reader_task = asyncio.create_task(self._read_loop())
+        await self.command('qmp_capabilities')
+
+    async def _read_loop(self):
+        while True:
+            line = await self._reader.readline()
+            if len(line) == 0:
+                break
+            msg = json.loads(line)
+            if 'event' in msg:
+                msg['recv_time'] = time.perf_counter()
+                async with self._events_cond:
+                    self.events.append(msg)
+                    self._events_cond.notify_all()
+            elif 'id' in msg and msg['id'] in self._responses:
+                fut = self._responses.pop(msg['id'])
+                if not fut.done():
+                    fut.set_result(msg)
+        # connection closed : fail pending commands and wake up event waiters
+        for fut in self._responses.values():
+            if not fut.done():
+                fut.set_exception(RuntimeError(f'QMP connection closed : {self.qmp_file}'))
+        self._responses.clear()
+        async with self._events_cond:
+            self._events_cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._reader_task is None or self._reader_task.done()
+
+    async def command(self, cmd, args=None, timeout=QemuQmp.COMMAND_TIMEOUT):
+        """
+        Send a command and wait for its response
+        Several commands can be awaited concurrently (pipelining)
+        """
+        cmd_id = self._next_id
+        self._next_id += 1
+        msg = {'execute': cmd, 'id': cmd_id}
+        if args is not None:
+            msg['arguments'] = args
+        fut = asyncio.get_running_loop().create_future()
+        self._responses[cmd_id] = fut
+        self._writer.write(json.dumps(msg).encode('utf-8') + b'\n')
+        await self._writer.drain()
+        response = await asyncio.wait_for(fut, timeout)
+        if 'error' in response:
+            raise RuntimeError(f'QMP command failed : {response["error"]}')
+        return response['return']
+
+    async def wait_event(self, events, timeout=QemuQmp.CONNECT_TIMEOUT, start=0):
+        """
+        Wait for one of the events (list of names) received after
+        the start-th event
+        """
+        def find():
+            for msg in self.events[start:]:
+                if msg['event'] in events:
+                    return msg
+            if self.closed:
+                raise RuntimeError(f'QMP connection closed : {self.qmp_file}')
+            return None
+        async with self._events_cond:
+            return await asyncio.wait_for(self._events_cond.wait_for(find), timeout)
+
+    async def wait_for_state(self, s, timeout=QemuQmp.CONNECT_TIMEOUT):
+        """
+        Wait until the VM run state (query-status) is s
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            start = len(self.events)
+            status = await self.command('query-status')
+            if status['status'] == s:
+                return True
+            try:
+                await self.wait_event(QemuQmp.STATE_EVENTS,
+                                      timeout=deadline - loop.time(), start=start)
+            except (RuntimeError, asyncio.TimeoutError):
+                raise RuntimeError('Check state failed : %s' % (s))
+
+    async def powerdown(self):
+        await self.command('system_powerdown')
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+
+class QemuMachineAsync:
+    """
+    asyncio counterpart of QemuMachine
+
+    The machine configuration, work directory and overlay image are
+    handled by a regular QemuMachine (available as self.machine), the
+    qemu process, the QMP connection and the readiness checks are driven
+    by coroutines, so one event loop can drive many machines without
+    one thread per VM.
+
+    Example:
+      async def boot(qm):
+          async with qm:
+              await qm.run()
+              await qm.wait_ready()
+      async def boot_all(machines):
+          await asyncio.gather(*[boot(qm) for qm in machines])
+      asyncio.run(boot_all([QemuMachineAsync() for _ in range(8)]))
+    """
+    READY_RETRY_SLEEP = 0.2
+    BANNER_TIMEOUT = 2
+
+    def __init__(self,
+                 name='default',
+                 machine=QemuEfiMachine.OVMF_Q35_TDX,
+                 memory='2G',
+                 service_blacklist=[]):
+        self.machine = QemuMachine(name, machine, memory, service_blacklist)
+        self.proc = None
+        self.qmp = None
+        self.readiness = None
+        self.out = None
+        self.err = None
+
+    @property
+    def name(self):
+        return self.machine.name
+
+    @property
+    def qcmd(self):
+        return self.machine.qcmd
+
+    @property
+    def workdir_name(self):
+        return self.machine.workdir_name
+
+    @property
+    def fwd_port(self):
+        return self.machine.fwd_port
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    async def run(self):
+        """
+        Run qemu and connect to its QMP socket
+        """
+        cmd = self.qcmd.get_command()
+        print(' '.join(cmd))
+        self.machine.write_cmd_to_file(f'{self.workdir_name}/run.sh')
+        self.readiness = self.machine._create_readiness()
+        self.proc = await asyncio.create_subprocess_exec(*cmd,
+                                                         stdout=asyncio.subprocess.PIPE,
+                                                         stderr=asyncio.subprocess.PIPE)
+        self.qmp = QemuQmpAsync(self.qcmd.qmp_file)
+        await self.qmp.connect(self.proc)
+
+    async def wait_ready(self, timeout=QemuSSH.CONNECT_TIMEOUT):
+        """
+        Wait for the SSH server of the guest to be available
+        (SSH banner received on the forwarded port)
+        The banner is only checked once the guest has announced sshd on
+        the serial console (or on timeout if it never does)
+        Returns the elapsed time in seconds
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        while self.readiness is not None and loop.time() - start < timeout:
+            self.readiness.poll()
+            if self.readiness.reached('sshd') or self.proc.returncode is not None:
+                break
+            await asyncio.sleep(QemuGuestReadiness.POLL_INTERVAL)
+        while True:
+            if self.proc.returncode is not None:
+                raise RuntimeError(f'QEMU exited before guest readiness ({self.workdir_name})')
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', self.fwd_port)
+                try:
+                    banner = await asyncio.wait_for(reader.readline(), self.BANNER_TIMEOUT)
+                finally:
+                    writer.close()
+                if banner.startswith(b'SSH-'):
+                    return loop.time() - start
+            except (OSError, asyncio.TimeoutError):
+                pass
+            if loop.time() - start >= timeout:
+                raise RuntimeError(f'Guest readiness timeout ({self.workdir_name})')
+            await asyncio.sleep(self.READY_RETRY_SLEEP)
+
+    async def ssh(self, timeout=QemuSSH.CONNECT_TIMEOUT):
+        """
+        Wait for guest readiness and return a QemuSSH client
+        """
+        await self.wait_ready(timeout)
+        return await asyncio.to_thread(QemuSSH, self, timeout, False)
+
+    async def communicate(self, timeout=60):
+        """
+        Wait for qemu to exit
+        """
+        self.out, self.err = await asyncio.wait_for(self.proc.communicate(), timeout)
+        if self.proc.returncode != 0:
+            print(self.err.decode())
+        return self.out, self.err
+
+    async def shutdown(self):
+        """
+        Send shutdown command to the VM
+        Do not wait for the VM to exit
+        Return false if the VM is already terminated
+        """
+        if self.proc is None or self.proc.returncode is not None:
+            return False
+        try:
+            await self.qmp.powerdown()
+        except Exception as e:
+            pass
+        return True
+
+    async def stop(self, timeout=60):
+        """
+        Stop qemu process
+        The QMP connection is closed even if qemu has already exited
+        """
+        try:
+            if not await self.shutdown():
+                return
+            try:
+                await self.communicate(timeout)
+            except Exception as e:
+                print(f'Qemu process did not shutdown properly, terminate it ... ({self.workdir_name})')
+                try:
+                    self.proc.terminate()
+                    await self.communicate(timeout)
+                except Exception as e:
+                    print(f'Exception {e}')
+        finally:
+            if self.qmp is not None:
+                await self.qmp.close()
+                self.qmp = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
@@ -0,0 +1,222 @@
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import csv
+import datetime
+import json
+import math
+import os
+import pathlib
+import statistics
+import subprocess
+
+import Qemu
+from bootprofile import BootProfiler
+
+# benchmark settings, can be overridden with environment variables
+BENCH_WARMUP = int(os.environ.get('TDXTEST_BENCH_WARMUP', 1))
+BENCH_REPEAT = int(os.environ.get('TDXTEST_BENCH_REPEAT', 5))
+# regression threshold : relative increase of the metric (0.1 -> 10%)
+BENCH_THRESHOLD = float(os.environ.get('TDXTEST_BENCH_THRESHOLD', 0.1))
+BENCH_HISTORY = os.environ.get('TDXTEST_BENCH_HISTORY', None)
+BENCH_BASELINE = os.environ.get('TDXTEST_BENCH_BASELINE', None)
+BENCH_UPDATE_BASELINE = os.environ.get('TDXTEST_BENCH_UPDATE_BASELINE', '0') == '1'
+
+def percentile(samples, p):
+    """
+    p-th percentile (0-100) of samples with linear interpolation
+    between the closest ranks
+    """
+    assert len(samples) > 0
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * p / 100
+    low = math.floor(rank)
+    high = math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def compute_stats(samples):
+    """
+    Statistics of a list of durations
+    """
+    samples = [s for s in samples if s is not None]
+    if len(samples) == 0:
+        return None
+    return {
+        'count': len(samples),
+        'mean': statistics.mean(samples),
+        'stddev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        'min': min(samples),
+        'max': max(samples),
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+    }
+
+def get_versions():
+    """
+    Versions of the components that affect the boot time
+    """
+    versions = {'kernel': os.uname().release}
+    try:
+        cs = subprocess.run(['qemu-system-x86_64', '--version'], capture_output=True)
+        versions['qemu'] = cs.stdout.decode().split('\n')[0]
+    except FileNotFoundError:
+        versions['qemu'] = None
+    tdx_module = pathlib.Path('/sys/firmware/tdx/tdx_module')
+    for attr in ['major_version', 'minor_version', 'build_num']:
+        try:
+            versions[f'tdx_module_{attr}'] = (tdx_module / attr).read_text().strip()
+        except OSError:
+            pass
+    return versions
+
+class BootBenchmark:
+    """
+    Measure the boot time of a machine configuration
+    Each run boots a fresh QemuMachine (profiled with BootProfiler),
+    the warmup runs are not taken into account.
+    """
+    def __init__(self,
+                 name,
+                 machine,
+                 memory='2G',
+                 warmup=BENCH_WARMUP,
+                 repeat=BENCH_REPEAT,
+                 timeout=200):
+        self.name = name
+        self.machine = machine
+        self.memory = memory
+        self.warmup = warmup
+        self.repeat = repeat
+        self.timeout = timeout
+
+    def _run_once(self):
+        with Qemu.QemuMachine(self.name, self.machine, memory=self.memory) as qm:
+            profile = BootProfiler(qm).boot(timeout=self.timeout)
+            qm.stop()
+        return profile
+
+    def run(self):
+        """
+        Run the benchmark and return the result (dict)
+        """
+        for i in range(self.warmup):
+            print(f'{self.name} : warmup run {i}')
+            self._run_once()
+
+        profiles = []
+        for i in range(self.repeat):
+            profile = self._run_once()
+            print(f'{self.name} : run {i} took {profile["total"]:.4f} seconds')
+            profiles.append(profile)
+
+        phases = {}
+        for profile in profiles:
+            for phase, duration in profile['phases'].items():
+                phases.setdefault(phase, []).append(duration)
+
+        return {
+            'name': self.name,
+            'machine': self.machine.name,
+            'memory': self.memory,
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'versions': get_versions(),
+            'warmup': self.warmup,
+            'samples': [p['total'] for p in profiles],
+            'stats': compute_stats([p['total'] for p in profiles]),
+            'phase_stats': {phase: compute_stats(d) for phase, d in phases.items()},
+        }
+
+class BenchmarkHistory:
+    """
+    Benchmark results history stored in a versioned JSON file
+    {'version': 1, 'results': [result, ...]}
+    """
+    FORMAT_VERSION = 1
+    CSV_FIELDS = ['date', 'name', 'machine', 'memory', 'kernel', 'qemu',
+                  'count', 'mean', 'stddev', 'min', 'max', 'p50', 'p95', 'p99']
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.results = []
+        if os.path.exists(fname):
+            with open(fname) as f:
+                content = json.load(f)
+            assert content.get('version') == self.FORMAT_VERSION, \
+                f'Unsupported benchmark history version in {fname}'
+            self.results = content['results']
+
+    def append(self, result):
+        self.results.append(result)
+
+    def save(self):
+        with open(self.fname, 'w') as f:
+            json.dump({'version': self.FORMAT_VERSION, 'results': self.results}, f, indent=2)
+
+    def to_csv(self, fname):
+        """
+        Export the history (one line per result) as CSV
+        """
+        with open(fname, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.CSV_FIELDS)
+            writer.writeheader()
+            for r in self.results:
+                row = {k: r.get(k) for k in ['date', 'name', 'machine', 'memory']}
+                row['kernel'] = r['versions'].get('kernel')
+                row['qemu'] = r['versions'].get('qemu')
+                row.update(r['stats'] or {})
+                writer.writerow(row)
+
+class BenchmarkBaseline:
+    """
+    Reference statistics per configuration name, stored as JSON
+    {'version': 1, 'baselines': {name: stats}}
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.baselines = {}
+        if os.path.exists(fname):
+            with open(fname) as f:
+                content = json.load(f)
+            assert content.get('version') == self.FORMAT_VERSION, \
+                f'Unsupported benchmark baseline version in {fname}'
+            self.baselines = content['baselines']
+
+    def update(self, result):
+        self.baselines[result['name']] = result['stats']
+
+    def save(self):
+        with open(self.fname, 'w') as f:
+            json.dump({'version': self.FORMAT_VERSION, 'baselines': self.baselines}, f, indent=2)
+
+    def check(self, result, threshold=BENCH_THRESHOLD, metrics=['p50', 'p95']):
+        """
+        Compare the result with the baseline of the same configuration
+        Returns the list of regressions (empty if none or no baseline)
+        """
+        baseline = self.baselines.get(result['name'])
+        if baseline is None:
+            print(f'No baseline for {result["name"]}')
+            return []
+        regressions = []
+        for metric in metrics:
+            ref = baseline[metric]
+            cur = result['stats'][metric]
+            if cur > ref * (1 + threshold):
+                regressions.append(f'{result["name"]} {metric} : {cur:.4f}s > '
+                                   f'{ref:.4f}s (baseline) + {threshold * 100:.0f}%')
+        return regressions
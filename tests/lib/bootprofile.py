@@ -0,0 +1,137 @@
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import re
+import time
+
+import Qemu
+
+class BootProfiler:
+    """
+    Boot a QEMU machine and split the boot time into phases
+
+    The phase boundaries come from:
+      - the host clock around the qemu process creation
+      - QMP : the VM is started paused, QMP availability marks the end of
+        the qemu initialization (including TDX VM creation and initial
+        memory setup), the RESUME event marks the start of the vCPUs
+      - the serial log milestones (see Qemu.QemuGuestReadiness)
+      - the SSH connection
+    Phases (seconds):
+      - spawn : creation of the qemu process
+      - vm_init : qemu initialization until the vCPUs are started
+      - firmware : OVMF/TDVF until boot loader hand-off, this includes
+        the acceptance of the TD private memory done by TDVF
+      - kernel : boot loader and kernel until systemd starts
+      - userspace : systemd until sshd is up
+      - sshd : sshd up until the SSH connection is established
+    The guest view of the boot (systemd-analyze) is also collected.
+    """
+    PHASES = [
+        ('spawn', 'start', 'spawned'),
+        ('vm_init', 'spawned', 'resume'),
+        ('firmware', 'resume', 'firmware'),
+        ('kernel', 'firmware', 'systemd'),
+        ('userspace', 'systemd', 'sshd'),
+        ('sshd', 'sshd', 'ssh_connected'),
+    ]
+
+    def __init__(self, qm):
+        self.qm = qm
+        self.marks = {}
+        self.profile = None
+
+    def boot(self, timeout=200):
+        """
+        Boot the machine, wait for SSH and return the profile (dict)
+        """
+        self.qm.qcmd.add_start_paused()
+
+        self.marks['start'] = time.perf_counter()
+        self.qm.run()
+        self.marks['spawned'] = time.perf_counter()
+
+        qmp = Qemu.QemuQmp(self.qm, timeout=timeout)
+        self.marks['qmp'] = time.perf_counter()
+        start = len(qmp.events)
+        qmp.command('cont')
+        self.marks['resume'] = qmp.wait_event(['RESUME'], timeout=timeout, start=start)['recv_time']
+
+        self.ssh = Qemu.QemuSSH(self.qm, timeout=timeout)
+        self.marks['ssh_connected'] = time.perf_counter()
+        if self.qm.readiness is not None:
+            self.marks.update(self.qm.readiness.timestamps)
+
+        self.profile = {
+            'name': self.qm.name,
+            'memory': self.qm.qcmd.plugins['memory'].memory,
+            'machine': self.qm.qcmd.plugins['machine'].machine.name,
+            'total': self.marks['ssh_connected'] - self.marks['start'],
+            'phases': self._phases(),
+            'milestones': {name: t - self.marks['start'] for name, t in self.marks.items()},
+            'guest': self.guest_boot_times(),
+        }
+        return self.profile
+
+    def _phases(self):
+        phases = {}
+        for name, begin, end in self.PHASES:
+            if begin in self.marks and end in self.marks:
+                phases[name] = self.marks[end] - self.marks[begin]
+            else:
+                # milestone not found in the serial log
+                phases[name] = None
+        return phases
+
+    def guest_boot_times(self, timeout=60):
+        """
+        Returns the boot times reported by systemd-analyze in the guest
+        ex: {'kernel': 2.1, 'initrd': 1.3, 'userspace': 8.2}
+        """
+        # systemd-analyze fails until the boot is finished
+        self.ssh.exec_command(f'timeout {timeout} systemctl is-system-running --wait')
+        ret, stdout, _ = self.ssh.exec_command('systemd-analyze time')
+        if ret != 0:
+            return {}
+        return parse_systemd_analyze(stdout.read().decode('utf-8'))
+
+    def save(self, fname):
+        """
+        Write the profile as JSON
+        """
+        with open(fname, 'w') as f:
+            json.dump(self.profile, f, indent=2)
+
+def _systemd_timespan_to_seconds(timespan):
+    """
+    Convert a systemd timespan (ex: '1min 2.345s', '850ms') to seconds
+    """
+    units = {'h': 3600, 'min': 60, 's': 1, 'ms': 1e-3, 'us': 1e-6}
+    total = 0
+    for value, unit in re.findall(r'([\d.]+)(h|min|ms|us|s)', timespan):
+        total += float(value) * units[unit]
+    return total
+
+def parse_systemd_analyze(output):
+    """
+    Parse the output of 'systemd-analyze time' :
+    Startup finished in 2.091s (kernel) + 1.2s (initrd) + 8.123s (userspace) = 11.414s
+    """
+    times = {}
+    line = output.split('\n')[0]
+    for timespan, phase in re.findall(r'((?:[\d.]+(?:h|min|ms|us|s)\s*)+)\((\w+)\)', line):
+        times[phase] = _systemd_timespan_to_seconds(timespan)
+    return times
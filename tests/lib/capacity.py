@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Host capacity probe
+
+All values are read directly from the kernel interfaces, without
+running any command:
+ - TDX key space : IA32_MKTME_KEYID_PARTITIONING MSR (/dev/cpu/0/msr)
+ - memory : /proc/meminfo
+ - running TDs : /proc/<pid>/cmdline
+"""
+
+import os
+import threading
+import time
+
+from tdxtools.host import MSR, readmsr
+
+# max age of a snapshot (seconds) before the values are read again
+SNAPSHOT_TTL = 1.0
+
+_lock = threading.Lock()
+_max_td_vms = None
+_snapshot = None
+
+def max_td_vms():
+    """
+    Number of TDX private keys (see util.get_max_td_vms)
+    The MSR cannot change until next reboot, so it is only read once
+    """
+    global _max_td_vms
+    if _max_td_vms is None:
+        # bits 63:32 : number of TDX private keys
+        # one key is reserved
+        _max_td_vms = readmsr(MSR.IA32_MKTME_PARTITIONING, 63, 32) - 1
+    return _max_td_vms
+
+def read_meminfo():
+    """
+    Content of /proc/meminfo as dict (values in kB)
+    """
+    meminfo = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            meminfo[key] = int(value.split()[0])
+    return meminfo
+
+def qemu_pids(tdx_only=True):
+    """
+    PIDs of the running qemu processes (TDs only by default)
+    """
+    pids = []
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry.name}/cmdline', 'rb') as f:
+                cmdline = f.read()
+        except OSError:
+            # process exited in the meantime
+            continue
+        argv0 = cmdline.split(b'\0', 1)[0]
+        if b'qemu-system' not in os.path.basename(argv0):
+            continue
+        if tdx_only and b'tdx' not in cmdline:
+            continue
+        pids.append(int(entry.name))
+    return pids
+
+class HostCapacitySnapshot:
+    """
+    Consistent view of the host capacity at a given time
+    Memory values are in GB
+    """
+    def __init__(self):
+        self.time = time.monotonic()
+        self.td_pids = qemu_pids()
+        meminfo = read_meminfo()
+        self.memory_total_gb = meminfo['MemTotal'] / (1024 * 1024)
+        self.memory_free_gb = meminfo['MemFree'] / (1024 * 1024)
+        self.memory_available_gb = meminfo['MemAvailable'] / (1024 * 1024)
+        self.cpus = os.cpu_count()
+        self.cpus_online = len(os.sched_getaffinity(0))
+
+    @property
+    def max_td_vms(self):
+        # read on first use only, the MSR read needs root
+        return max_td_vms()
+
+    @property
+    def current_td_vms(self):
+        return len(self.td_pids)
+
+    @property
+    def available_td_vms(self):
+        return self.max_td_vms - self.current_td_vms
+
+    @property
+    def age(self):
+        return time.monotonic() - self.time
+
+    def __str__(self):
+        return (f'TDs {self.current_td_vms}/{self.max_td_vms}, '
+                f'memory {self.memory_available_gb:.1f}G available / {self.memory_total_gb:.1f}G, '
+                f'CPUs {self.cpus_online}/{self.cpus}')
+
+def snapshot(max_age=SNAPSHOT_TTL):
+    """
+    Return the cached snapshot if it is more recent than max_age (seconds),
+    take a new one otherwise (max_age=0 forces a new snapshot)
+    """
+    global _snapshot
+    with _lock:
+        if _snapshot is None or _snapshot.age >= max_age:
+            _snapshot = HostCapacitySnapshot()
+        return _snapshot
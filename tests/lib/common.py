@@ -15,13 +15,176 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import fcntl
+import glob
+import hashlib
 import os
+import pathlib
+import subprocess
+import time
 import Qemu
 
 script_path=os.path.dirname(os.path.realpath(__file__)) + '/'
 # put in /var/tmp instead of /tmp to be persistent across reboots 
 guest_workdir='/var/tmp/tdxtest'
+# content hash of the last deployment done in the guest
+deploy_marker=f'{guest_workdir}/.tdxtest-deployed'
+# content hash of lib/ when the guest setup (lib/setup_guest.sh) has been done
+setup_marker=f'{guest_workdir}/.tdxtest-setup'
+# files that are not needed in the guest and change at each run
+deploy_excludes=Qemu.QemuSync.DEFAULT_EXCLUDES + ['__pycache__', '*.pyc']
+# pre-baked test-ready image layers
+layer_dir='/var/tmp/tdxtest/layers'
+# unused layers are removed after this delay (seconds)
+layer_prune_delay=24 * 3600
+# locks of the layers used by this process (see build_test_ready_image)
+_layer_locks = []
+
+_content_hashes = {}
+
+def content_hash(folder):
+    """
+    Hash of the content of a folder, computed once per session
+    """
+    folder = os.path.realpath(folder)
+    if folder not in _content_hashes:
+        manifest = Qemu.QemuSync(None, excludes=deploy_excludes).local_manifest(folder)
+        h = hashlib.sha256()
+        for f in sorted(manifest):
+            h.update(f'{f}\0{manifest[f][2]}\n'.encode('utf-8'))
+        _content_hashes[folder] = h.hexdigest()
+    return _content_hashes[folder]
+
+def deployment_hash():
+    """
+    Hash of the deployed tree (test tree including lib/setup_guest.sh)
+    """
+    return content_hash(f'{script_path}/../')
+
+def setup_hash():
+    """
+    Hash of the content the guest setup depends on (lib/)
+    """
+    return content_hash(script_path)
+
+def _read_marker(m : Qemu.QemuSSH, marker):
+    ret, stdout, _ = m.exec_command(f'cat {marker}')
+    if ret != 0:
+        return None
+    return stdout.read().decode('utf-8').strip()
+
+def is_deployed(m : Qemu.QemuSSH):
+    """
+    Whether the current test tree has already been deployed and set up in the guest
+    """
+    return _read_marker(m, deploy_marker) == deployment_hash()
 
 def deploy_and_setup(m : Qemu.QemuSSH):
-    m.rsync_file(f'{script_path}/../', f'{guest_workdir}')
-    m.check_exec(f'cd {guest_workdir} && ./lib/setup_guest.sh')
+    if is_deployed(m):
+        print('Guest deployment is up to date')
+        return
+    # only the modified files are transferred
+    m.rsync_file(f'{script_path}/../', f'{guest_workdir}', excludes=deploy_excludes)
+    if _read_marker(m, setup_marker) != setup_hash():
+        m.check_exec(f'cd {guest_workdir} && ./lib/setup_guest.sh')
+        m.check_exec(f'echo {setup_hash()} > {setup_marker}')
+    m.check_exec(f'echo {deployment_hash()} > {deploy_marker} && sync')
+
+def _lock_layer(layer, operation):
+    """
+    Open the lock file of a layer and lock it (fcntl.flock operation)
+    Returns the lock file, None if the lock is not available (LOCK_NB)
+    """
+    while True:
+        lock = open(f'{layer}.lock', 'a')
+        try:
+            fcntl.flock(lock, operation)
+        except BlockingIOError:
+            lock.close()
+            return None
+        # the lock file may have been removed (prune_layers) while waiting
+        try:
+            if os.stat(lock.name).st_ino == os.fstat(lock.fileno()).st_ino:
+                return lock
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+def prune_layers(keep):
+    """
+    Remove the test-ready image layers (and their lock files) other than
+    keep that have not been used for layer_prune_delay and that no test
+    session uses (shared lock held by build_test_ready_image)
+    """
+    layers = set(glob.glob(f'{layer_dir}/tdx-guest-ready-*.qcow2')) | \
+        set(f[:-len('.lock')] for f in glob.glob(f'{layer_dir}/tdx-guest-ready-*.qcow2.lock'))
+    for layer in sorted(layers - {keep}):
+        try:
+            if time.time() - os.path.getmtime(f'{layer}.lock') < layer_prune_delay:
+                continue
+        except FileNotFoundError:
+            pass
+        lock = _lock_layer(layer, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if lock is None:
+            continue
+        with lock:
+            print(f'Remove old test-ready image layer {layer}')
+            for f in [layer, f'{layer}.tmp', lock.name]:
+                pathlib.Path(f).unlink(missing_ok=True)
+
+def build_test_ready_image(base_img=None, timeout=200):
+    """
+    Build a qcow2 layer on top of the guest image in which the test tree
+    is deployed and the guest setup (lib/setup_guest.sh) is done.
+    The layer is keyed by the content hash of lib/ and by the base image,
+    it is only built when one of them changes.
+    The layer is backing file of the machines of the test session, its
+    lock is held (shared) until the end of the process so that the other
+    sessions do not remove it (see prune_layers).
+    Returns the path of the layer
+    """
+    if base_img is None:
+        base_img = Qemu.QemuMachine.default_guest_image()
+    st = os.stat(base_img)
+    key = hashlib.sha256(f'{os.path.realpath(base_img)}:{st.st_mtime_ns}:{st.st_size}:{setup_hash()}'
+                         .encode('utf-8')).hexdigest()[:16]
+    layer = f'{layer_dir}/tdx-guest-ready-{key}.qcow2'
+
+    os.makedirs(layer_dir, exist_ok=True)
+    lock = _lock_layer(layer, fcntl.LOCK_SH)
+    try:
+        # last use of the layer
+        os.utime(lock.name)
+        if not os.path.exists(layer):
+            # several test sessions might build the layer at the same time
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(layer):
+                _build_layer(base_img, layer, timeout)
+            fcntl.flock(lock, fcntl.LOCK_SH)
+    except:
+        lock.close()
+        raise
+    _layer_locks.append(lock)
+
+    prune_layers(keep=layer)
+    return layer
+
+def _build_layer(base_img, layer, timeout):
+    print(f'Build test-ready image layer {layer}')
+    tmp_layer = f'{layer}.tmp'
+    subprocess.check_call(['qemu-img', 'create', '-f', 'qcow2',
+                           '-b', base_img, '-F', 'qcow2', tmp_layer],
+                          stdout=subprocess.DEVNULL)
+    try:
+        # the guest writes directly to the layer
+        with Qemu.QemuMachine('image-build', image=tmp_layer) as qm:
+            qm.run()
+            m = Qemu.QemuSSH(qm, timeout=timeout)
+            deploy_and_setup(m)
+            # clean shutdown to have a consistent layer
+            qm.stop()
+            assert qm.proc.returncode == 0, 'Guest did not shutdown properly'
+    except:
+        pathlib.Path(tmp_layer).unlink(missing_ok=True)
+        raise
+    os.replace(tmp_layer, layer)
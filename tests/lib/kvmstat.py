@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+KVM counters of a machine, collected on the host
+
+The counters are read before and after a test region and the deltas are
+reported. Sources:
+ - binary stats of the VM and its vCPUs (KVM_GET_STATS_FD ioctl on the
+   qemu KVM file descriptors, see Documentation/virt/kvm/api.rst)
+   or, if not available, the VM folder in debugfs (/sys/kernel/debug/kvm/<pid>-<fd>)
+ - host wide KVM counters in debugfs (/sys/kernel/debug/kvm/*)
+ - optionally, the count of the kvm:* tracepoints (exits, page faults,
+   hypercalls, ...) hit by the qemu process, with perf stat
+
+Example:
+  with kvmstat.KvmStats(qm, perf=True) as stats:
+      ... workload ...
+  print(stats.deltas)
+"""
+
+import ctypes
+import json
+import os
+import signal
+import struct
+import subprocess
+
+# collect the tracepoints counts with perf, can be enabled with TDXTEST_KVMSTAT_PERF=1
+KVMSTAT_PERF = os.environ.get('TDXTEST_KVMSTAT_PERF', '0') == '1'
+
+DEBUGFS_KVM = '/sys/kernel/debug/kvm'
+
+# _IO(KVMIO, 0xce)
+KVM_GET_STATS_FD = 0xAECE
+SYS_PIDFD_GETFD = 438
+
+# struct kvm_stats_header
+STATS_HEADER = struct.Struct('IIIIII')
+# struct kvm_stats_desc without the name
+STATS_DESC = struct.Struct('IhHII')
+
+KVM_STATS_TYPE_MASK = 0xf
+KVM_STATS_TYPE_CUMULATIVE = 0
+KVM_STATS_TYPE_INSTANT = 1
+KVM_STATS_TYPE_PEAK = 2
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+def _pidfd_getfd(pidfd, fd):
+    newfd = _libc.syscall(SYS_PIDFD_GETFD, pidfd, fd, 0)
+    if newfd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return newfd
+
+def read_stats_fd(stats_fd):
+    """
+    Read the scalar counters of a KVM binary stats file descriptor
+    Returns {name: (type, value)}
+    """
+    flags, name_size, num_desc, id_offset, desc_offset, data_offset = \
+        STATS_HEADER.unpack(os.pread(stats_fd, STATS_HEADER.size, 0))
+    desc_size = STATS_DESC.size + name_size
+    descs = os.pread(stats_fd, desc_size * num_desc, desc_offset)
+    stats = {}
+    for i in range(num_desc):
+        base = i * desc_size
+        flags, exponent, size, offset, bucket_size = STATS_DESC.unpack_from(descs, base)
+        # histograms are not reported
+        if size != 1:
+            continue
+        name = descs[base + STATS_DESC.size:base + desc_size].split(b'\0', 1)[0].decode()
+        value = struct.unpack('Q', os.pread(stats_fd, 8, data_offset + offset))[0]
+        stats[name] = (flags & KVM_STATS_TYPE_MASK, value)
+    return stats
+
+def kvm_fds(pid):
+    """
+    KVM file descriptors of a qemu process
+    Returns the VM fd and the list of the vCPU fds
+    """
+    vm_fd = None
+    vcpu_fds = []
+    for fd in os.listdir(f'/proc/{pid}/fd'):
+        try:
+            target = os.readlink(f'/proc/{pid}/fd/{fd}')
+        except OSError:
+            continue
+        if target == 'anon_inode:kvm-vm':
+            vm_fd = int(fd)
+        elif target.startswith('anon_inode:kvm-vcpu'):
+            vcpu_fds.append(int(fd))
+    return vm_fd, vcpu_fds
+
+def _merge(stats, new, prefix, types):
+    for name, (stat_type, value) in new.items():
+        key = f'{prefix}.{name}'
+        types[key] = stat_type
+        if key not in stats:
+            stats[key] = value
+        elif stat_type == KVM_STATS_TYPE_PEAK:
+            stats[key] = max(stats[key], value)
+        else:
+            # vCPU counters are summed over the vCPUs
+            stats[key] += value
+
+def read_vm_stats(pid, types=None):
+    """
+    VM and vCPU (summed over all vCPUs) counters from the binary stats,
+    the type of each counter is stored in types
+    The KVM file descriptors of qemu are duplicated (pidfd_getfd), they are
+    closed right after the read to not keep a reference on the VM
+    """
+    if types is None:
+        types = {}
+    vm_fd, vcpu_fds = kvm_fds(pid)
+    if vm_fd is None:
+        raise RuntimeError(f'No KVM VM in process {pid}')
+    stats = {}
+    pidfd = os.pidfd_open(pid)
+    try:
+        for fd, prefix in [(vm_fd, 'vm')] + [(fd, 'vcpu') for fd in vcpu_fds]:
+            kvm_fd = _pidfd_getfd(pidfd, fd)
+            try:
+                stats_fd = _libc.ioctl(kvm_fd, KVM_GET_STATS_FD, 0)
+                if stats_fd < 0:
+                    errno = ctypes.get_errno()
+                    raise OSError(errno, os.strerror(errno))
+                try:
+                    _merge(stats, read_stats_fd(stats_fd), prefix, types)
+                finally:
+                    os.close(stats_fd)
+            finally:
+                os.close(kvm_fd)
+    finally:
+        os.close(pidfd)
+    return stats
+
+def _read_debugfs_dir(path, prefix):
+    stats = {}
+    for name in os.listdir(path):
+        fname = os.path.join(path, name)
+        if not os.path.isfile(fname):
+            continue
+        try:
+            with open(fname) as f:
+                stats[f'{prefix}.{name}'] = int(f.read())
+        except (OSError, ValueError):
+            # histograms, not readable files
+            pass
+    return stats
+
+def read_debugfs_vm_stats(pid):
+    """
+    VM counters (VM and vCPUs summed) from the VM folder in debugfs
+    """
+    stats = {}
+    for entry in os.listdir(DEBUGFS_KVM):
+        if entry.split('-')[0] == str(pid):
+            stats.update(_read_debugfs_dir(os.path.join(DEBUGFS_KVM, entry), 'vm'))
+    if len(stats) == 0:
+        raise RuntimeError(f'No KVM debugfs folder for process {pid}')
+    return stats
+
+def read_debugfs_host_stats():
+    """
+    Host wide KVM counters
+    """
+    return _read_debugfs_dir(DEBUGFS_KVM, 'host')
+
+class PerfKvmCounter:
+    """
+    Count the kvm:* tracepoints hit by a process with perf stat
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.proc = None
+
+    def start(self):
+        self.proc = subprocess.Popen(['perf', 'stat', '-x', ',', '-e', 'kvm:*', '-p', str(self.pid)],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def stop(self):
+        """
+        Returns {tracepoint: count}
+        """
+        self.proc.send_signal(signal.SIGINT)
+        _, err = self.proc.communicate(timeout=30)
+        counts = {}
+        for line in err.decode().splitlines():
+            # CSV : count,unit,event,...
+            fields = line.split(',')
+            if len(fields) < 3 or not fields[0].isdigit():
+                continue
+            counts[f'perf.{fields[2]}'] = int(fields[0])
+        return counts
+
+class KvmStats:
+    """
+    KVM counters deltas of a machine over a region
+    Each source that cannot be read (no debugfs, no perf, ...) is reported
+    in errors and ignored
+    """
+    def __init__(self, qm, perf=KVMSTAT_PERF):
+        self.qm = qm
+        self.perf = perf
+        self.pid = None
+        self.before = {}
+        self.deltas = {}
+        self.errors = {}
+        # type of the binary stats counters
+        self.types = {}
+        self._perf_counter = None
+
+    def snapshot(self):
+        stats = {}
+        try:
+            stats.update(read_vm_stats(self.pid, self.types))
+        except Exception as e:
+            self.errors['stats_fd'] = str(e)
+            try:
+                stats.update(read_debugfs_vm_stats(self.pid))
+            except Exception as e:
+                self.errors['debugfs_vm'] = str(e)
+        try:
+            stats.update(read_debugfs_host_stats())
+        except Exception as e:
+            self.errors['debugfs_host'] = str(e)
+        return stats
+
+    def start(self):
+        self.pid = self.qm.proc.pid if self.qm.proc is not None else self.qm.pid
+        self.before = self.snapshot()
+        if self.perf:
+            try:
+                self._perf_counter = PerfKvmCounter(self.pid)
+                self._perf_counter.start()
+            except Exception as e:
+                self.errors['perf'] = str(e)
+                self._perf_counter = None
+        return self
+
+    def stop(self):
+        after = self.snapshot()
+        self.deltas = {}
+        for name, value in after.items():
+            if self.types.get(name, KVM_STATS_TYPE_CUMULATIVE) == KVM_STATS_TYPE_CUMULATIVE:
+                self.deltas[name] = value - self.before.get(name, 0)
+            else:
+                # instant and peak values are reported as is
+                self.deltas[name] = value
+        if self._perf_counter is not None:
+            try:
+                self.deltas.update(self._perf_counter.stop())
+            except Exception as e:
+                self.errors['perf'] = str(e)
+        return self.deltas
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.stop()
+
+    def top(self, count=20, prefix=None):
+        """
+        The highest non-zero deltas
+        """
+        deltas = [(n, v) for n, v in self.deltas.items()
+                  if v != 0 and (prefix is None or n.startswith(prefix))]
+        return sorted(deltas, key=lambda d: d[1], reverse=True)[:count]
+
+    def print_top(self, count=20):
+        for name, value in self.top(count):
+            print(f'  {name:<40} : {value}')
+
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump({'pid': self.pid, 'deltas': self.deltas, 'errors': self.errors}, f, indent=2)
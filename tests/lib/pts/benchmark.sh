@@ -66,5 +66,7 @@ PTS_SILENT_MODE=1 phoronix-test-suite batch-benchmark $TEST_PROFILE
 phoronix-test-suite result-file-raw-to-csv $TEST_RESULTS_NAME
 
 cp ${HOME}/memory-benchmark-raw.csv ${SCRIPT_DIR}/benchmark.csv
+# the result file has the direction of each result (lower/higher is better)
+cp $PTS_FOLDER/test-results/$TEST_RESULTS_NAME/composite.xml ${SCRIPT_DIR}/composite.xml
 
 echo " end test $(date +%s)"
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Phoronix Test Suite (PTS) results : TDX overhead of the TD against
+the normal VM, per benchmark (see tests/perf/test_perf_benchmark.py)
+"""
+
+import csv
+import datetime
+import json
+import os
+import random
+import statistics
+import xml.etree.ElementTree as ET
+
+import benchmark
+
+PTS_HISTORY = os.environ.get('TDXTEST_PTS_HISTORY', None)
+
+# confidence level of the overhead intervals
+CONFIDENCE = 0.95
+BOOTSTRAP_RESAMPLES = 2000
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def parse_pts_csv(fname):
+    """
+    Parse the output of 'phoronix-test-suite result-file-raw-to-csv'
+    Each result is a title line followed by one line per result identifier
+    with the raw values of all the runs:
+      "Stream - Type: Copy"
+      "tdx-memory-benchmark-id",45231.2,45100.1,45300.4
+    Returns {title: [values]}
+    """
+    results = {}
+    title = None
+    with open(fname, newline='') as f:
+        for row in csv.reader(f):
+            row = [c.strip() for c in row if c.strip() != '']
+            if len(row) == 0:
+                continue
+            values = [_to_float(c) for c in row[1:]]
+            if len(values) > 0 and None not in values:
+                if title is not None:
+                    results.setdefault(title, []).extend(values)
+            elif len(row) == 1 and _to_float(row[0]) is None:
+                title = row[0]
+    return results
+
+def parse_pts_composite(fname):
+    """
+    Direction of the results from the PTS result file (composite.xml),
+    the Proportion of a result is LIB (lower is better) or HIB (higher
+    is better)
+    Returns {title: True if lower is better, False if higher is better}
+    with the titles of parse_pts_csv ("Title - Description")
+    """
+    directions = {}
+    for result in ET.parse(fname).getroot().iter('Result'):
+        proportion = (result.findtext('Proportion') or '').strip().upper()
+        if proportion not in ['LIB', 'HIB']:
+            continue
+        title = (result.findtext('Title') or '').strip()
+        description = (result.findtext('Description') or '').strip()
+        if description != '':
+            title = f'{title} - {description}'
+        directions[title] = proportion == 'LIB'
+    return directions
+
+def overhead(normal, td, lower_better=False):
+    """
+    Relative cost (%) of the TD against the normal VM, from the mean
+    of the samples, positive when the TD is slower
+    """
+    ratio = statistics.mean(td) / statistics.mean(normal)
+    return (ratio - 1) * 100 if lower_better else (1 - ratio) * 100
+
+def overhead_ci(normal, td, lower_better=False, confidence=CONFIDENCE,
+                resamples=BOOTSTRAP_RESAMPLES, seed=0):
+    """
+    Bootstrap (percentile) confidence interval of the overhead
+    Returns None if there are not enough samples
+    """
+    if len(normal) < 2 or len(td) < 2:
+        return None
+    rng = random.Random(seed)
+    estimates = []
+    for _ in range(resamples):
+        n = [rng.choice(normal) for _ in normal]
+        t = [rng.choice(td) for _ in td]
+        estimates.append(overhead(n, t, lower_better))
+    estimates.sort()
+    alpha = (1 - confidence) / 2
+    return [benchmark.percentile(estimates, alpha * 100),
+            benchmark.percentile(estimates, (1 - alpha) * 100)]
+
+class OverheadReport:
+    """
+    TDX overhead per benchmark present in both results
+    directions : {title: lower is better} (see parse_pts_composite), the
+    overhead of a benchmark without direction is not computed (unknown)
+    """
+    def __init__(self, normal, td, directions, versions=None):
+        self.date = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.versions = versions if versions is not None else benchmark.get_versions()
+        self.benchmarks = {}
+        for title in normal:
+            if title not in td or len(normal[title]) == 0 or len(td[title]) == 0:
+                continue
+            lower_better = directions.get(title)
+            self.benchmarks[title] = {
+                'lower_is_better': lower_better,
+                'normal_mean': statistics.mean(normal[title]),
+                'td_mean': statistics.mean(td[title]),
+                'normal_samples': len(normal[title]),
+                'td_samples': len(td[title]),
+                'overhead': None,
+                'ci': None,
+            }
+            if lower_better is not None:
+                self.benchmarks[title]['overhead'] = overhead(normal[title], td[title], lower_better)
+                self.benchmarks[title]['ci'] = overhead_ci(normal[title], td[title], lower_better)
+
+    def to_dict(self):
+        return {'date': self.date, 'versions': self.versions,
+                'confidence': CONFIDENCE, 'benchmarks': self.benchmarks}
+
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def diff(self, previous=None):
+        """
+        Text report of the overheads, compared with a previous report (dict)
+        A change is flagged when the confidence intervals do not overlap
+        """
+        lines = [f'TDX overhead (kernel {self.versions.get("kernel")}, '
+                 f'{self.versions.get("qemu")})']
+        if previous is not None:
+            lines.append(f'compared with {previous["date"]} (kernel {previous["versions"].get("kernel")})')
+        for title, b in self.benchmarks.items():
+            if b['overhead'] is None:
+                lines.append(f'  {title} : unknown (no result direction)')
+                continue
+            ci = f'[{b["ci"][0]:+.1f}%, {b["ci"][1]:+.1f}%]' if b['ci'] is not None else '[-]'
+            line = f'  {title} : {b["overhead"]:+.1f}% {ci}'
+            prev = None if previous is None else previous['benchmarks'].get(title)
+            if prev is not None and prev['overhead'] is not None:
+                line += f', was {prev["overhead"]:+.1f}% ({b["overhead"] - prev["overhead"]:+.1f})'
+                if b['ci'] is not None and prev['ci'] is not None and \
+                   (b['ci'][0] > prev['ci'][1] or b['ci'][1] < prev['ci'][0]):
+                    line += ' CHANGED'
+            elif previous is not None:
+                line += ', new'
+            lines.append(line)
+        return '\n'.join(lines)
+
+class OverheadHistory:
+    """
+    Overhead reports history stored in a versioned JSON file
+    {'version': 1, 'reports': [report, ...]}
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.reports = []
+        if os.path.exists(fname):
+            with open(fname) as f:
+                content = json.load(f)
+            assert content.get('version') == self.FORMAT_VERSION, \
+                f'Unsupported PTS history version in {fname}'
+            self.reports = content['reports']
+
+    def last(self):
+        return self.reports[-1] if len(self.reports) > 0 else None
+
+    def append(self, report):
+        self.reports.append(report.to_dict())
+
+    def save(self):
+        with open(self.fname, 'w') as f:
+            json.dump({'version': self.FORMAT_VERSION, 'reports': self.reports}, f, indent=2)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Resource-aware parallel test runner
+
+Tests are collected with pytest (this module is also a pytest plugin that
+dumps the resources of the collected tests), then each test is run in its
+own pytest process as soon as the host has enough capacity for it:
+ - TD slots (TDX keys)
+ - available memory
+ - CPUs
+(see capacity.HostCapacitySnapshot)
+
+Tests declare their needs with markers (default: one TD, see DEFAULT_RESOURCES):
+ - @pytest.mark.resources(tds=1, memory='2G', vcpus=16)
+ - @pytest.mark.host_lock('vsock') : the test uses a host resource (service,
+   vsock CID, port, ...) that cannot be shared, tests with a common lock are
+   not run at the same time
+ - @pytest.mark.exclusive : the test needs the whole host
+
+Exclusive tests are run at the end, one at a time.
+
+Usage: scheduler.py [-j N] [pytest args]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import capacity
+
+# resources of a test without resources marker, this is
+# the configuration of a default QemuMachine
+DEFAULT_RESOURCES = {'tds': 1, 'memory': '2G', 'vcpus': 16}
+# memory kept for the host
+RESERVED_MEMORY_GB = 4
+POLL_INTERVAL = 0.5
+# each test process gets its own range of TCP ports for the forwarded
+# ports of its machines (TDXTEST_PORT_RANGE, see util.tcp_port_available),
+# below the ephemeral port range of Linux (32768-60999)
+PORT_BASE = 10000
+PORT_RANGE_SIZE = 100
+PORT_SLOTS = 200
+
+def memory_to_gb(memory):
+    """
+    Convert a QEMU memory size ('512M', '2G', '1T') to GB
+    """
+    memory = str(memory)
+    units = {'M': 1 / 1024, 'G': 1, 'T': 1024}
+    if memory[-1].upper() in units:
+        return float(memory[:-1]) * units[memory[-1].upper()]
+    return float(memory)
+
+# pytest plugin part (loaded with -p scheduler)
+
+def pytest_addoption(parser):
+    parser.addoption('--tdx-schedule-dump', default=None,
+                     help='dump the resources of the collected tests to this file (JSON)')
+
+def pytest_collection_finish(session):
+    fname = session.config.getoption('tdx_schedule_dump')
+    if fname is None:
+        return
+    tests = []
+    for item in session.items:
+        resources = dict(DEFAULT_RESOURCES)
+        mark = item.get_closest_marker('resources')
+        if mark is not None:
+            resources.update(mark.kwargs)
+        tests.append({
+            'nodeid': item.nodeid,
+            'tds': resources['tds'],
+            'memory': memory_to_gb(resources['memory']),
+            'vcpus': resources['vcpus'],
+            'locks': sorted({name for mark in item.iter_markers('host_lock') for name in mark.args}),
+            'exclusive': item.get_closest_marker('exclusive') is not None,
+        })
+    with open(fname, 'w') as f:
+        json.dump(tests, f, indent=2)
+
+# runner part
+
+class HostCapacity:
+    """
+    Resources available on the host for the tests
+    """
+    def __init__(self, tds=None, memory=None, vcpus=None):
+        if None in [tds, memory, vcpus]:
+            host = capacity.snapshot()
+        if tds is None:
+            tds = host.available_td_vms
+        if memory is None:
+            memory = host.memory_available_gb - RESERVED_MEMORY_GB
+        if vcpus is None:
+            vcpus = host.cpus_online
+        self.total = {'tds': tds, 'memory': memory, 'vcpus': vcpus}
+        self.used = {'tds': 0, 'memory': 0, 'vcpus': 0}
+
+    def fits(self, test):
+        return all(self.used[r] + test[r] <= self.total[r] for r in self.total)
+
+    def can_ever_fit(self, test):
+        return all(test[r] <= self.total[r] for r in self.total)
+
+    def allocate(self, test):
+        for r in self.used:
+            self.used[r] += test[r]
+
+    def release(self, test):
+        for r in self.used:
+            self.used[r] -= test[r]
+
+    def __str__(self):
+        return (f'{self.total["tds"]} TDs, {self.total["memory"]:.1f}G memory, '
+                f'{self.total["vcpus"]} CPUs')
+
+class TestScheduler:
+    """
+    Run the collected tests in parallel within the host capacity
+    """
+    def __init__(self, tests, host, max_jobs=None, logdir=None):
+        self.capacity = host
+        self.max_jobs = max_jobs
+        self.logdir = logdir or tempfile.mkdtemp(prefix='tdxtest-sched-')
+        os.makedirs(self.logdir, exist_ok=True)
+        self.shared = []
+        self.exclusive = []
+        for t in tests:
+            if t['exclusive'] or not host.can_ever_fit(t):
+                self.exclusive.append(t)
+            else:
+                self.shared.append(t)
+        self.running = {}
+        self.free_port_slots = list(range(PORT_SLOTS))
+        # host locks held by the running tests
+        self.locks = set()
+        self.results = []
+
+    def _env(self, port_slot):
+        env = dict(os.environ)
+        # a session pool per test process would only waste TD slots
+        env['TDXTEST_POOL_SIZE'] = '0'
+        start = PORT_BASE + port_slot * PORT_RANGE_SIZE
+        env['TDXTEST_PORT_RANGE'] = f'{start}-{start + PORT_RANGE_SIZE}'
+        return env
+
+    def _start(self, test):
+        log = os.path.join(self.logdir, test['nodeid'].replace('/', '_').replace('::', '-') + '.log')
+        f = open(log, 'w')
+        port_slot = self.free_port_slots.pop(0)
+        proc = subprocess.Popen([sys.executable, '-m', 'pytest', '-s', '-v', test['nodeid']],
+                                stdout=f, stderr=subprocess.STDOUT, env=self._env(port_slot))
+        f.close()
+        self.capacity.allocate(test)
+        self.locks.update(test['locks'])
+        self.running[proc] = (test, time.perf_counter(), log, port_slot)
+        print(f'[start] {test["nodeid"]}', flush=True)
+
+    def _reap(self):
+        done = [p for p in self.running if p.poll() is not None]
+        for proc in done:
+            test, start, log, port_slot = self.running.pop(proc)
+            self.free_port_slots.append(port_slot)
+            self.capacity.release(test)
+            self.locks.difference_update(test['locks'])
+            # 5 : no test collected (deselected by marker)
+            status = {0: 'PASSED', 5: 'SKIPPED'}.get(proc.returncode, 'FAILED')
+            duration = time.perf_counter() - start
+            self.results.append({'nodeid': test['nodeid'], 'status': status,
+                                 'duration': duration, 'log': log})
+            print(f'[{status.lower()}] {test["nodeid"]} ({duration:.1f}s)', flush=True)
+        return len(done)
+
+    def _full(self):
+        if len(self.free_port_slots) == 0:
+            return True
+        return self.max_jobs is not None and len(self.running) >= self.max_jobs
+
+    def run(self):
+        start = time.perf_counter()
+        pending = list(self.shared)
+        while pending or self.running:
+            # first fit : start all pending tests that fit in the remaining capacity
+            for test in list(pending):
+                if self._full():
+                    break
+                if self.capacity.fits(test) and self.locks.isdisjoint(test['locks']):
+                    pending.remove(test)
+                    self._start(test)
+            if not self._reap():
+                time.sleep(POLL_INTERVAL)
+
+        for test in self.exclusive:
+            self._start(test)
+            while not self._reap():
+                time.sleep(POLL_INTERVAL)
+
+        return time.perf_counter() - start
+
+    def summary(self, wall_time):
+        serial_time = sum(r['duration'] for r in self.results)
+        print(f'\n{"=" * 20} scheduler summary {"=" * 20}')
+        for r in self.results:
+            if r['status'] == 'FAILED':
+                print(f'FAILED {r["nodeid"]} (log: {r["log"]})')
+        counts = {s: len([r for r in self.results if r['status'] == s])
+                  for s in ['PASSED', 'FAILED', 'SKIPPED']}
+        print(', '.join(f'{n} {s.lower()}' for s, n in counts.items()))
+        print(f'Wall time {wall_time:.1f}s, sum of test durations {serial_time:.1f}s '
+              f'(parallelism {serial_time / max(wall_time, 1e-6):.1f})')
+        print(f'Test logs in {self.logdir}')
+        return counts['FAILED'] == 0
+
+def collect(pytest_args):
+    with tempfile.NamedTemporaryFile(suffix='.json') as f:
+        cs = subprocess.run([sys.executable, '-m', 'pytest', '-p', 'scheduler', '--co', '-q',
+                             f'--tdx-schedule-dump={f.name}'] + pytest_args,
+                            stdout=subprocess.DEVNULL)
+        assert cs.returncode in [0, 5], f'Test collection failed ({cs.returncode})'
+        if cs.returncode == 5:
+            return []
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the TDX tests in parallel')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='max number of tests run in parallel (default: host capacity)')
+    parser.add_argument('--logdir', default=None,
+                        help='folder to store the output of each test')
+    args, pytest_args = parser.parse_known_args()
+    # the test processes are part of the same session (see conftest.py)
+    os.environ.setdefault('TDXTEST_SESSION_START', str(time.time()))
+
+    tests = collect(pytest_args)
+    host = HostCapacity()
+    print(f'Host capacity : {host}')
+    scheduler = TestScheduler(tests, host, max_jobs=args.jobs, logdir=args.logdir)
+    print(f'{len(scheduler.shared)} tests to run in parallel, '
+          f'{len(scheduler.exclusive)} exclusive tests')
+    wall_time = scheduler.run()
+    sys.exit(0 if scheduler.summary(wall_time) else 1)
+
+if __name__ == '__main__':
+    main()
@@ -2,30 +2,60 @@
 Manage the binary blob
 """
 import logging
+import mmap
 import string
 import struct
 import binascii
 
 LOG = logging.getLogger(__name__)
 
+_UINT16 = struct.Struct("<H")
+_UINT32 = struct.Struct("<L")
+_UINT64 = struct.Struct("<Q")
+
 __author__ = "cpio"
 
 
 class BinaryBlob:
     """
     Manage the binary blob.
+
+    The blob is a view on the data (bytes, bytearray, mmap, memoryview...),
+    the data is never copied: the integers are unpacked in place and
+    get_bytes returns a memoryview on the data.
+    A blob can be a region [offset, offset + length[ of a larger buffer.
     """
 
-    def __init__(self, data, base=0):
+    def __init__(self, data, base=0, offset=0, length=None):
+        self._view = memoryview(data).cast('B')
+        if offset != 0 or length is not None:
+            end = len(self._view) if length is None else offset + length
+            assert end <= len(self._view)
+            self._view = self._view[offset:end]
+            data = self._view
         self._data = data
         self._base_address = base
 
+    @staticmethod
+    def read_file(path, use_mmap=True):
+        """
+        Content of a file, memory mapped if possible (read only) and
+        read otherwise (sysfs attributes without mmap support, ...)
+        """
+        with open(path, "rb") as fobj:
+            if use_mmap:
+                try:
+                    return mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    pass
+            return fobj.read()
+
     @property
     def length(self):
         """
         Length of binary in bytes
         """
-        return len(self._data)
+        return len(self._view)
 
     @property
     def data(self):
@@ -38,44 +68,44 @@ class BinaryBlob:
         """
         To hex string
         """
-        return "".join(f"{b:02x}" % b for b in self._data)
+        return self._view.hex()
 
     def get_uint16(self, pos):
         """
         Get UINT16 integer
         """
         assert pos + 2 <= self.length
-        return (struct.unpack("<H", self.data[pos:pos + 2])[0], pos + 2)
+        return (_UINT16.unpack_from(self._view, pos)[0], pos + 2)
 
     def get_uint8(self, pos):
         """
         Get UINT8 integer
         """
         assert pos + 1 <= self.length
-        return (self.data[pos], pos + 1)
+        return (self._view[pos], pos + 1)
 
     def get_uint32(self, pos):
         """
         Get UINT32 integer
         """
         assert pos + 4 <= self.length
-        return (struct.unpack("<L", self.data[pos:pos + 4])[0], pos + 4)
+        return (_UINT32.unpack_from(self._view, pos)[0], pos + 4)
 
     def get_uint64(self, pos):
         """
         Get UINT64 integer
         """
         assert pos + 8 <= self.length
-        return (struct.unpack("<Q", self.data[pos:pos + 8])[0], pos + 8)
+        return (_UINT64.unpack_from(self._view, pos)[0], pos + 8)
 
     def get_bytes(self, pos, count):
         """
-        Get bytes
+        Get bytes, as a memoryview on the data (no copy)
         """
         if count == 0:
             return None
         assert pos + count <= self.length
-        return (self.data[pos:pos + count], pos + count)
+        return (self._view[pos:pos + count], pos + count)
 
     def get_as_hex_string(self, pos, count):
         """
@@ -104,10 +134,10 @@ class BinaryBlob:
                     self._base_address)
 
             # pylint: disable=consider-using-f-string
-            linestr += "{0:02X} ".format(self._data[index])
-            if chr(self._data[index]) in set(string.printable) and \
-               self._data[index] not in [0xC, 0xB, 0xA, 0xD, 0x9]:
-                printstr += chr(self._data[index])
+            linestr += "{0:02X} ".format(self._view[index])
+            if chr(self._view[index]) in set(string.printable) and \
+               self._view[index] not in [0xC, 0xB, 0xA, 0xD, 0x9]:
+                printstr += chr(self._view[index])
             else:
                 printstr += '.'
 
@@ -69,7 +69,7 @@ class CCEL(BinaryBlob, dict):
         OEM ID value in byte array
         """
         oem_id, _ = self.get_bytes(10, 6)
-        return oem_id
+        return bytes(oem_id)
 
     @property
     def cc_type(self):
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Host side verification of the RTMRs of many TDs
+
+The data of each TD is collected in the guest into a folder:
+  ccel     : CCEL ACPI table (/sys/firmware/acpi/tables/CCEL)
+  eventlog : event log (/sys/firmware/acpi/tables/data/CCEL)
+  tdreport : raw TDREPORT (tdreport --output tdreport)
+
+The event logs are replayed in parallel (one process per core) and the
+identical event logs (TDs booted from the same image) are replayed once.
+The replayed RTMRs of each TD are compared with the RTMRs of its TDREPORT.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from .ccel import CCEL
+from .measurement import hash_file
+from .rtmr import RTMR
+from .tdeventlog import TDEventLogActor
+from .tdreport import TdInfo, DEV_1_5
+
+LOG = logging.getLogger(__name__)
+
+CCEL_FILE = "ccel"
+EVENTLOG_FILE = "eventlog"
+TDREPORT_FILE = "tdreport"
+
+# TDINFO_STRUCT in TDREPORT_STRUCT, the RTMRs are at the same offsets
+# in TDX 1.0 and 1.5
+TDINFO_OFFSET = 0x200
+TDINFO_LENGTH = 0x200
+
+def is_td_dir(path):
+    """
+    Folder with the data of a TD
+    """
+    return os.path.isfile(os.path.join(path, EVENTLOG_FILE)) and \
+        os.path.isfile(os.path.join(path, TDREPORT_FILE))
+
+def find_td_dirs(paths):
+    """
+    TD folders: the given folders or their sub-folders
+    """
+    td_dirs = []
+    for path in paths:
+        if is_td_dir(path):
+            td_dirs.append(path)
+            continue
+        for entry in sorted(os.listdir(path)):
+            if is_td_dir(os.path.join(path, entry)):
+                td_dirs.append(os.path.join(path, entry))
+    return td_dirs
+
+def read_report_rtmrs(fname):
+    """
+    RTMRs (hex strings) of a raw TDREPORT
+    """
+    with open(fname, "rb") as fobj:
+        data = fobj.read()
+    assert len(data) >= TDINFO_OFFSET + TDINFO_LENGTH, f"Invalid TDREPORT {fname}"
+    td_info = TdInfo(memoryview(data)[TDINFO_OFFSET:TDINFO_OFFSET + TDINFO_LENGTH], DEV_1_5)
+    return [td_info[f"rtmr_{index}"] for index in range(RTMR.RTMR_COUNT)]
+
+def log_length(td_dir):
+    """
+    Length of the event log area, from the CCEL table if present
+    """
+    ccel_file = os.path.join(td_dir, CCEL_FILE)
+    if os.path.isfile(ccel_file):
+        with open(ccel_file, "rb") as fobj:
+            ccel = CCEL(fobj.read())
+        assert ccel.is_valid(), f"Invalid CCEL table {ccel_file}"
+        return ccel.log_area_minimum_length
+    return os.path.getsize(os.path.join(td_dir, EVENTLOG_FILE))
+
+def replay_event_log(fname, length):
+    """
+    Replay an event log file, run in a worker process
+    Returns {'events': count, 'rtmrs': [hex strings]} or {'error': message}
+    """
+    try:
+        actor = TDEventLogActor(0, length, ccel_file=fname)
+        rtmrs = actor.replay()
+        return {"events": actor.rtmr_replay.count,
+                "rtmrs": [rtmrs[index].to_hex_string() for index in range(RTMR.RTMR_COUNT)]}
+    # pylint: disable=broad-except
+    except Exception as e:
+        return {"error": f"Cannot replay {fname} : {e!r}"}
+
+class FleetVerifier:
+    """
+    Verify the RTMRs of a set of TDs
+    """
+
+    def __init__(self, td_dirs, jobs=None):
+        self.td_dirs = td_dirs
+        self.jobs = jobs
+        # per TD: name, log, rtmrs, result
+        self.results = []
+        # content hash of the event log -> replay result
+        self.replays = {}
+
+    def run(self):
+        """
+        Replay the distinct event logs in parallel and check each TD
+        Returns True if all the TDs pass
+        """
+        tds = []
+        logs = {}
+        for td_dir in self.td_dirs:
+            td = {"name": os.path.basename(os.path.normpath(td_dir)), "log": None}
+            try:
+                eventlog = os.path.join(td_dir, EVENTLOG_FILE)
+                length = log_length(td_dir)
+                td["log"] = f"{hash_file(eventlog, ('sha256',))['sha256'].hex()}-{length:x}"
+                td["report_rtmrs"] = read_report_rtmrs(os.path.join(td_dir, TDREPORT_FILE))
+                logs.setdefault(td["log"], (eventlog, length))
+            # pylint: disable=broad-except
+            except Exception as e:
+                td["error"] = str(e)
+            tds.append(td)
+
+        LOG.debug("%d TDs, %d distinct event logs", len(tds), len(logs))
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {key: executor.submit(replay_event_log, fname, length)
+                       for key, (fname, length) in logs.items()}
+            self.replays = {key: future.result() for key, future in futures.items()}
+
+        self.results = [self._check(td) for td in tds]
+        return all(r["result"] == "PASS" for r in self.results)
+
+    def _check(self, td):
+        result = {"name": td["name"], "log": td["log"], "events": None,
+                  "rtmrs": [None] * RTMR.RTMR_COUNT, "result": "ERROR"}
+        replay = self.replays.get(td["log"], {})
+        error = td.get("error", replay.get("error"))
+        if error is not None:
+            result["error"] = error
+            return result
+        result["events"] = replay["events"]
+        result["rtmrs"] = [replayed == reported for replayed, reported
+                           in zip(replay["rtmrs"], td["report_rtmrs"])]
+        result["result"] = "PASS" if all(result["rtmrs"]) else "FAIL"
+        return result
+
+    def print_table(self):
+        """
+        Per TD pass/fail table
+        """
+        width = max([len("TD")] + [len(r["name"]) for r in self.results])
+        print(f"{'TD':<{width}}  {'EVENT LOG':<12} {'EVENTS':>6}  "
+              + " ".join(f"RTMR{index}" for index in range(RTMR.RTMR_COUNT)) + "  RESULT")
+        for r in self.results:
+            log = r["log"][:12] if r["log"] is not None else "-"
+            events = r["events"] if r["events"] is not None else "-"
+            rtmrs = " ".join(f"{'-' if ok is None else 'ok' if ok else 'FAIL':<5}"
+                             for ok in r["rtmrs"])
+            line = f"{r['name']:<{width}}  {log:<12} {events:>6}  {rtmrs}  {r['result']}"
+            if "error" in r:
+                line += f" ({r['error']})"
+            print(line)
+        passed = sum(1 for r in self.results if r["result"] == "PASS")
+        print(f"{passed}/{len(self.results)} TDs passed, "
+              f"{len(self.replays)} distinct event logs replayed")
+
+    def save(self, fname):
+        with open(fname, "w", encoding="utf-8") as fobj:
+            json.dump(self.results, fobj, indent=2)
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(
+        description="Verify the RTMRs of TDs from their collected event logs and TDREPORTs")
+    parser.add_argument("paths", nargs="+",
+                        help=f"TD folder ({CCEL_FILE}, {EVENTLOG_FILE}, {TDREPORT_FILE}) "
+                             "or folder of TD folders")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="JSON output file")
+    args = parser.parse_args()
+
+    td_dirs = find_td_dirs(args.paths)
+    if len(td_dirs) == 0:
+        LOG.error("No TD folder found in %s", " ".join(args.paths))
+        sys.exit(2)
+
+    verifier = FleetVerifier(td_dirs, args.jobs)
+    passed = verifier.run()
+    verifier.print_table()
+    if args.output is not None:
+        verifier.save(args.output)
+    sys.exit(0 if passed else 1)
@@ -76,6 +76,7 @@ def readmsr(msr, highbit=63, lowbit=0, cpu=0):
     fdobj = os.open(f'/dev/cpu/{cpu}/msr', os.O_RDONLY)
     os.lseek(fdobj, msr, os.SEEK_SET)
     val = struct.unpack('Q', os.read(fdobj, 8))[0]
+    os.close(fdobj)
     bits = highbit - lowbit + 1
     if bits < 64:
         val >>= lowbit
@@ -0,0 +1,160 @@
+"""
+Measurement of files (kernel, initrd, ...) to compare with the digests
+of the event log.
+
+The files are hashed by chunks (memory mapped if possible) with all the
+requested algorithms in one pass, and the digests are cached by
+(path, inode, size, mtime) so that an unchanged file is not read again,
+by the same process or by another tool.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+
+LOG = logging.getLogger(__name__)
+
+# hashlib names of the digest algorithms of the event log
+# (TPM_ALG_SHA256, TPM_ALG_SHA384, TPM_ALG_SHA512 in TCGAlgorithmRegistry)
+SUPPORTED_ALGORITHMS = ("sha256", "sha384", "sha512")
+DEFAULT_ALGORITHMS = ("sha384",)
+
+CHUNK_SIZE = 1024 * 1024
+
+def _default_cache_file():
+    cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_dir, "tdxtools", "measurements.json")
+
+CACHE_FILE = os.environ.get("TDXTOOLS_MEASUREMENT_CACHE", _default_cache_file())
+
+def hash_file(path, algorithms=DEFAULT_ALGORITHMS, use_mmap=True, chunk_size=CHUNK_SIZE):
+    """
+    Digests of a file for each algorithm, in one pass over the file
+    Each chunk is hashed by all the algorithms while it is in the CPU cache
+    Returns {algorithm: digest bytes}
+    """
+    for name in algorithms:
+        assert name in SUPPORTED_ALGORITHMS, f"Unsupported algorithm {name}"
+    hashes = {name: hashlib.new(name) for name in algorithms}
+
+    with open(path, "rb") as fobj:
+        mapped = None
+        if use_mmap:
+            try:
+                mapped = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # empty file, file without mmap support
+                mapped = None
+
+        if mapped is not None:
+            with mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, len(view), chunk_size):
+                        chunk = view[offset:offset + chunk_size]
+                        for h in hashes.values():
+                            h.update(chunk)
+                        chunk.release()
+                finally:
+                    view.release()
+        else:
+            buf = bytearray(chunk_size)
+            view = memoryview(buf)
+            while True:
+                count = fobj.readinto(buf)
+                if not count:
+                    break
+                for h in hashes.values():
+                    h.update(view[:count])
+
+    return {name: h.digest() for name, h in hashes.items()}
+
+class MeasurementCache:
+    """
+    Digests of files keyed by (path, inode, size, mtime), stored in a JSON
+    file if fname is not None
+    """
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        # path -> {'key': [inode, size, mtime], 'digests': {algorithm: hex}}
+        self._entries = {}
+        if fname is not None and os.path.exists(fname):
+            try:
+                with open(fname, "r", encoding="utf-8") as fobj:
+                    self._entries = json.load(fobj)
+            except (OSError, ValueError):
+                LOG.warning("Ignore invalid measurement cache %s", fname)
+                self._entries = {}
+
+    @staticmethod
+    def file_key(path):
+        """
+        Key of the current version of a file
+        """
+        stat = os.stat(path)
+        return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+    def lookup(self, path, algorithms=DEFAULT_ALGORITHMS):
+        """
+        Cached digests of a file, None if the file has changed or if an
+        algorithm is missing
+        """
+        path = os.path.realpath(path)
+        entry = self._entries.get(path)
+        if entry is None or entry["key"] != self.file_key(path):
+            return None
+        if any(name not in entry["digests"] for name in algorithms):
+            return None
+        return {name: bytes.fromhex(entry["digests"][name]) for name in algorithms}
+
+    def measure(self, path, algorithms=DEFAULT_ALGORITHMS):
+        """
+        Digests of a file, the file is read only if it is not in the cache
+        Returns {algorithm: digest bytes}
+        """
+        digests = self.lookup(path, algorithms)
+        if digests is not None:
+            return digests
+
+        path = os.path.realpath(path)
+        key = self.file_key(path)
+        digests = hash_file(path, algorithms)
+        entry = self._entries.get(path)
+        if entry is None or entry["key"] != key:
+            entry = {"key": key, "digests": {}}
+            self._entries[path] = entry
+        entry["digests"].update({name: d.hex() for name, d in digests.items()})
+        self.save()
+        return digests
+
+    def save(self):
+        """
+        Write the cache file, errors are ignored (read-only home, ...)
+        """
+        if self.fname is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            tmp = f"{self.fname}.{os.getpid()}"
+            with open(tmp, "w", encoding="utf-8") as fobj:
+                json.dump(self._entries, fobj)
+            os.replace(tmp, self.fname)
+        except OSError as e:
+            LOG.debug("Could not write the measurement cache %s : %s", self.fname, e)
+
+_cache = None
+
+def measure_file(path, algorithms=DEFAULT_ALGORITHMS, use_cache=True):
+    """
+    Digests of a file {algorithm: digest bytes}, with the shared cache
+    (see TDXTOOLS_MEASUREMENT_CACHE)
+    """
+    global _cache # pylint: disable=global-statement
+    if not use_cache:
+        return hash_file(path, algorithms)
+    if _cache is None:
+        _cache = MeasurementCache(CACHE_FILE)
+    return _cache.measure(path, algorithms)
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Microbenchmarks of the guest operations that have a specific cost in a TD
+
+In a TD, CPUID, port I/O and MMIO are not handled by the CPU but trigger
+a #VE that the guest kernel converts into a TDVMCALL to the host, private
+memory has to be accepted before its first use and the DMA of the virtio
+devices goes through the swiotlb bounce buffers.
+All the benchmarks can run in a normal VM to have a reference.
+
+Each benchmark gives a distribution of samples (latency in microseconds
+or throughput in MB/s), not a single value.
+"""
+
+import argparse
+import ctypes
+import glob
+import json
+import logging
+import math
+import mmap
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from .utility import DeviceNode
+
+LOG = logging.getLogger(__name__)
+
+PAGE_SIZE = mmap.PAGESIZE
+
+class BenchmarkSkipped(Exception):
+    """
+    The benchmark cannot run in this guest (missing device, ...)
+    """
+
+def percentile(samples, p):
+    """
+    p-th percentile (0-100) of sorted samples with linear interpolation
+    """
+    rank = (len(samples) - 1) * p / 100
+    low = math.floor(rank)
+    high = math.ceil(rank)
+    return samples[low] + (samples[high] - samples[low]) * (rank - low)
+
+def distribution(samples, unit):
+    """
+    Summary statistics of the samples
+    """
+    ordered = sorted(samples)
+    return {
+        'unit': unit,
+        'count': len(ordered),
+        'mean': statistics.mean(ordered),
+        'stddev': statistics.stdev(ordered) if len(ordered) > 1 else 0.0,
+        'min': ordered[0],
+        'p50': percentile(ordered, 50),
+        'p95': percentile(ordered, 95),
+        'p99': percentile(ordered, 99),
+        'max': ordered[-1],
+    }
+
+def _latencies(func, iterations, warmup=3):
+    """
+    Latency (us) of each call of func
+    """
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        func()
+        samples.append((time.perf_counter_ns() - start) / 1000)
+    return samples
+
+def bench_tdreport(iterations):
+    """
+    TDREPORT ioctl on the TDX guest device (TDG.MR.REPORT)
+    """
+    device_node = DeviceNode()
+    if device_node.device_node_name is None:
+        raise BenchmarkSkipped('No TDX guest device')
+    report_data = os.urandom(64)
+    def get_report():
+        assert device_node.get_tdreport_bytes(report_data) is not None, 'TDREPORT failed'
+    return _latencies(get_report, iterations)
+
+def bench_tsm_quote(iterations, tsm_dir=Path('/sys/kernel/config/tsm/report/')):
+    """
+    Quote generation through configfs-tsm (TDVMCALL GetQuote + QGS round trip)
+    """
+    if not tsm_dir.exists():
+        raise BenchmarkSkipped(f'No configfs-tsm : {tsm_dir}')
+    report = tsm_dir / f'microbench-{os.getpid()}'
+    report.mkdir()
+    try:
+        def get_quote():
+            (report / 'inblob').write_bytes(os.urandom(64))
+            assert len((report / 'outblob').read_bytes()) > 0, 'Empty quote'
+        return _latencies(get_quote, iterations, warmup=1)
+    finally:
+        report.rmdir()
+
+def bench_cpuid(iterations, leaf=0x40000000):
+    """
+    CPUID through the cpuid driver
+    The default leaf is the hypervisor leaf, always emulated by the host
+    (#VE and TDVMCALL in a TD), most of the other leaves are handled by
+    the TDX module without exit to the host
+    """
+    if not os.path.exists('/dev/cpu/0/cpuid'):
+        subprocess.run(['modprobe', 'cpuid'], check=False)
+    try:
+        fd = os.open('/dev/cpu/0/cpuid', os.O_RDONLY)
+    except OSError as e:
+        raise BenchmarkSkipped(f'No cpuid device : {e}')
+    try:
+        return _latencies(lambda: os.pread(fd, 16, leaf), iterations)
+    finally:
+        os.close(fd)
+
+def bench_port_io(iterations, port=0x80):
+    """
+    Port I/O read (IN instruction, TDVMCALL in a TD) through /dev/port
+    Port 0x80 (POST code) has no side effect
+    """
+    try:
+        fd = os.open('/dev/port', os.O_RDONLY)
+    except OSError as e:
+        raise BenchmarkSkipped(f'No port device : {e}')
+    try:
+        return _latencies(lambda: os.pread(fd, 1, port), iterations)
+    finally:
+        os.close(fd)
+
+# PCI vendor ID of the virtio devices
+VIRTIO_VENDOR_ID = 0x1af4
+# IORESOURCE_MEM in the flags of the sysfs resource file
+IORESOURCE_MEM = 0x200
+
+def _virtio_memory_bar():
+    """
+    sysfs resource file of the first memory BAR of a virtio PCI device
+    At offset 0 of the BAR is the MSI-X table (legacy virtio) or the
+    common configuration (modern virtio), the reads have no side effect
+    """
+    for dev in sorted(glob.glob('/sys/bus/pci/devices/*')):
+        with open(os.path.join(dev, 'vendor')) as f:
+            if int(f.read(), 16) != VIRTIO_VENDOR_ID:
+                continue
+        with open(os.path.join(dev, 'resource')) as f:
+            # one line per resource : start end flags
+            for index, line in enumerate(f):
+                start, end, flags = (int(v, 16) for v in line.split())
+                if flags & IORESOURCE_MEM and end > start:
+                    path = os.path.join(dev, f'resource{index}')
+                    if os.path.exists(path):
+                        return path
+    return None
+
+def bench_mmio(iterations):
+    """
+    MMIO read (#VE and TDVMCALL in a TD) : 32-bit load from the memory BAR
+    of a virtio device mapped in the process
+    """
+    resource = _virtio_memory_bar()
+    if resource is None:
+        raise BenchmarkSkipped('No virtio device with a memory BAR')
+    try:
+        fd = os.open(resource, os.O_RDWR)
+    except OSError as e:
+        raise BenchmarkSkipped(f'Cannot open {resource} : {e}')
+    try:
+        bar = mmap.mmap(fd, PAGE_SIZE, flags=mmap.MAP_SHARED)
+    except OSError as e:
+        raise BenchmarkSkipped(f'Cannot map {resource} : {e}')
+    finally:
+        os.close(fd)
+    # one 32-bit load per read, the register is never written
+    reg = ctypes.c_uint32.from_buffer(bar)
+    try:
+        # a kernel without support of the MMIO from user space in a TD
+        # kills the process, try once in a child process
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = 0 if reg.value is not None else 1
+            finally:
+                os._exit(code) # pylint: disable=protected-access
+        _, status = os.waitpid(pid, 0)
+        if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+            raise BenchmarkSkipped(f'MMIO read of {resource} failed : status {status}')
+        return _latencies(lambda: reg.value, iterations)
+    finally:
+        del reg
+        bar.close()
+
+def bench_first_touch(iterations, size=64 * 1024 * 1024):
+    """
+    Cost (us) per page of the first write to newly allocated memory
+    (page fault, page clearing and, in a TD, acceptance of the private page)
+    compared with a second write of the same memory
+    """
+    libc = ctypes.CDLL(None)
+    first = []
+    second = []
+    pages = size // PAGE_SIZE
+    for _ in range(iterations):
+        buf = mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+        ptr = ctypes.c_char.from_buffer(buf)
+        for samples in [first, second]:
+            start = time.perf_counter_ns()
+            libc.memset(ctypes.byref(ptr), 1, ctypes.c_size_t(size))
+            samples.append((time.perf_counter_ns() - start) / 1000 / pages)
+        # release the buffer export before unmapping
+        del ptr
+        buf.close()
+    return {'first_touch': first, 'second_touch': second}
+
+def _virtio_block_device():
+    for dev in sorted(glob.glob('/sys/block/vd*')):
+        return f'/dev/{os.path.basename(dev)}'
+    return None
+
+def bench_swiotlb(iterations, size=64 * 1024 * 1024, chunk=1024 * 1024):
+    """
+    Throughput (MB/s) of direct reads from the virtio disk, the DMA goes
+    through the swiotlb bounce buffers in a TD
+    """
+    device = _virtio_block_device()
+    if device is None:
+        raise BenchmarkSkipped('No virtio block device')
+    try:
+        fd = os.open(device, os.O_RDONLY | os.O_DIRECT)
+    except OSError as e:
+        raise BenchmarkSkipped(f'Cannot open {device} : {e}')
+    # O_DIRECT needs an aligned buffer, mmap memory is page aligned
+    buf = mmap.mmap(-1, chunk)
+    samples = []
+    try:
+        for _ in range(iterations):
+            start = time.perf_counter_ns()
+            offset = 0
+            while offset < size:
+                read = os.preadv(fd, [buf], offset)
+                if read <= 0:
+                    break
+                offset += read
+            samples.append(offset / ((time.perf_counter_ns() - start) / 1e9) / 1e6)
+    finally:
+        buf.close()
+        os.close(fd)
+    return samples
+
+# name : (function, default iterations, unit)
+BENCHMARKS = {
+    'tdreport': (bench_tdreport, 1000, 'us'),
+    'tsm_quote': (bench_tsm_quote, 10, 'us'),
+    'cpuid': (bench_cpuid, 10000, 'us'),
+    'port_io': (bench_port_io, 10000, 'us'),
+    'mmio': (bench_mmio, 10000, 'us'),
+    'first_touch': (bench_first_touch, 10, 'us/page'),
+    'swiotlb': (bench_swiotlb, 10, 'MB/s'),
+}
+
+def run_benchmarks(names=None, iterations=None):
+    """
+    Run the benchmarks and return their distributions
+    {name: distribution} or {name: {'skipped': reason}}
+    """
+    if names is None:
+        names = list(BENCHMARKS.keys())
+    results = {}
+    for name in names:
+        func, default_iterations, unit = BENCHMARKS[name]
+        LOG.info("Run %s", name)
+        try:
+            samples = func(iterations or default_iterations)
+        except BenchmarkSkipped as e:
+            LOG.info("Skip %s : %s", name, e)
+            results[name] = {'skipped': str(e)}
+            continue
+        if isinstance(samples, dict):
+            for variant, variant_samples in samples.items():
+                results[f'{name}.{variant}'] = distribution(variant_samples, unit)
+        else:
+            results[name] = distribution(samples, unit)
+    return results
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+    parser = argparse.ArgumentParser(description='TDX guest microbenchmarks')
+    parser.add_argument('-b', '--benchmark', action='append', choices=list(BENCHMARKS.keys()),
+                        help='benchmark to run (default: all)')
+    parser.add_argument('-n', '--iterations', type=int, default=None,
+                        help='number of samples (default: per benchmark)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='JSON output file (default: stdout)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.benchmark, args.iterations)
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
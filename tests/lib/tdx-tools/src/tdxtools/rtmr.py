@@ -2,6 +2,8 @@
 RTMR data structures
 """
 
+from hashlib import sha384
+
 from .binaryblob import BinaryBlob
 
 
@@ -22,3 +24,116 @@ class RTMR(BinaryBlob):
         bytearray_2, _ = other.get_bytes(0, RTMR.RTMR_LENGTH_BY_BYTES)
 
         return bytearray(bytearray_1) == bytearray(bytearray_2)
+
+
+class RTMRReplay:
+    """
+    Incremental replay of the RTMR registers from the event logs.
+    The running value and the number of events of each register are kept,
+    so that a growing log is replayed by extending the registers with the
+    new event logs only:
+
+    rtmr[N] = sha384(rtmr[N-1] || digest[N])
+    rtmr[0] = 00..00 (all zeroed)
+
+    With keep_history, the value after each event is kept and the first
+    event where two replays diverge is found by binary search.
+    """
+
+    def __init__(self, keep_history=True):
+        self._values = [bytes(RTMR.RTMR_LENGTH_BY_BYTES)] * RTMR.RTMR_COUNT
+        self._counts = [0] * RTMR.RTMR_COUNT
+        self._keep_history = keep_history
+        # history[index][n] : value after the n first events of the register
+        self._history = [[value] for value in self._values]
+        self._event_logs = [[] for _ in range(RTMR.RTMR_COUNT)]
+
+    @property
+    def count(self):
+        """
+        Number of event logs replayed, all registers
+        """
+        return sum(self._counts)
+
+    def count_by_index(self, index: int) -> int:
+        """
+        Number of event logs replayed in a register
+        """
+        return self._counts[index]
+
+    def extend(self, event_log) -> bytes:
+        """
+        Extend the register of the event log with its (first) digest
+        Returns the new value of the register
+        """
+        index = event_log.rtmr
+        value = sha384(self._values[index])
+        value.update(event_log.digests[0])
+        self._values[index] = value.digest()
+        self._counts[index] += 1
+        if self._keep_history:
+            self._history[index].append(self._values[index])
+            self._event_logs[index].append(event_log)
+        return self._values[index]
+
+    def extend_all(self, event_logs) -> None:
+        """
+        Extend the registers with a list of event logs
+        """
+        for event_log in event_logs:
+            self.extend(event_log)
+
+    def value(self, index: int) -> RTMR:
+        """
+        Current value of a register
+        """
+        return RTMR(self._values[index])
+
+    def values(self):
+        """
+        Current value of all the registers {index: RTMR}
+        """
+        return {index: self.value(index) for index in range(RTMR.RTMR_COUNT)}
+
+    def intermediate(self, index: int, count: int) -> bytes:
+        """
+        Value of a register after its first count event logs
+        """
+        assert self._keep_history, "No history kept"
+        return self._history[index][count]
+
+    def event_log(self, index: int, position: int):
+        """
+        Event log at position (0 based) in the event logs of a register
+        """
+        assert self._keep_history, "No history kept"
+        return self._event_logs[index][position]
+
+    def first_divergence(self, index: int, other: "RTMRReplay"):
+        """
+        Position (0 based, in the event logs of the register) of the first
+        event log after which the register differs from the other replay,
+        None if the replays of the register are identical.
+        A difference propagates to all the following values, so the first
+        one is found by binary search in the histories.
+        """
+        # pylint: disable=protected-access
+        assert self._keep_history and other._keep_history, "No history kept"
+        history = self._history[index]
+        other_history = other._history[index]
+        common = min(len(history), len(other_history)) - 1
+        if history[common] == other_history[common]:
+            if len(history) == len(other_history):
+                return None
+            # one replay is a prefix of the other one
+            return common
+
+        # history[low] are equal, history[high] differ
+        low, high = 0, common
+        while high - low > 1:
+            middle = (low + high) // 2
+            if history[middle] == other_history[middle]:
+                low = middle
+            else:
+                high = middle
+        return high - 1
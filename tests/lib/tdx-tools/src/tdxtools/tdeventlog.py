@@ -3,14 +3,13 @@ TD Event log package.
 """
 
 import logging
-from typing import List
 from typing import Dict, List
 import os
-from hashlib import sha384
 
 from .binaryblob import BinaryBlob
 from .ccel import CCEL
-from .rtmr import RTMR
+from .measurement import measure_file
+from .rtmr import RTMR, RTMRReplay
 
 LOG = logging.getLogger(__name__)
 
@@ -142,6 +141,13 @@ class TDEventLogBase:
         self._etype = 0
         self._digest_count = 0
 
+    @property
+    def address(self):
+        """
+        Address of the entry in memory
+        """
+        return self._address
+
     @property
     def length(self):
         """
@@ -288,45 +294,91 @@ class TDEventLogActor:
     Event log actor
     """
 
-    def __init__(self, base, length):
-        self._data = None
+    CCEL_DATA_FILE = "/sys/firmware/acpi/tables/data/CCEL"
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, base, length, ccel_file=CCEL_DATA_FILE):
         self._log_base = base
         self._log_length = length
+        self._ccel_file = ccel_file
         self._specid_header = None
         self._event_logs = []
+        self._complete = False
+        # offset of the end of the processed entries in the log
+        self._processed_length = 0
+        # raw digest (all algorithms) -> event logs, built by process()
+        self._digest_index = {}
+        self._rtmr_replay = RTMRReplay()
         self._rtmrs = {}
 
-    def _read(self, ccel_file="/sys/firmware/acpi/tables/data/CCEL"):
+    def iter_events(self, ccel_file=None, chunk_size=CHUNK_SIZE):
+        """
+        Generator of the event log entries, the CCEL data file is read by
+        chunks while the entries are parsed and the read stops at the end
+        of the log (0xFFFFFFFF), not at the end of the log area.
+        The entries are taken from memory if the log has been processed.
+        """
+        if self._complete:
+            yield from self._event_logs
+            return
+        yield from self._parse(ccel_file or self._ccel_file, chunk_size, 0)
+
+    def _parse(self, ccel_file, chunk_size, start):
+        """
+        Parse the entries of the log from offset start
+        """
         assert os.path.exists(ccel_file), f"Could not find the CCEL file {ccel_file}"
         try:
-            with open(ccel_file, "rb") as fobj:
-                self._data = fobj.read()
-                assert len(self._data) > 0
-                return self._data
+            fobj = open(ccel_file, "rb")
         except (PermissionError, OSError):
             LOG.error("Need root permission to open file %s", ccel_file)
-            return None
-
-    @staticmethod
-    def _replay_single_rtmr(event_logs: List[TDEventLogEntry]) -> RTMR:
-        """
-        Each digest of an event log will be appended to the previous RTMR value
-        and hashed to obtain the new RTMR value
-
-        N = nb of event logs (>0)
-        rtmr[N] = sha384(rtmr[N-1].append(digest[N]))
-        rtmr[0] = 00..00 (all zeroed)
-        """
-        rtmr = bytearray(RTMR.RTMR_LENGTH_BY_BYTES)
-
-        for event_log in event_logs:
-            digest = event_log.digests[0]
-            sha384_algo = sha384()
-            extended = rtmr + digest
-            sha384_algo.update(extended)
-            rtmr = sha384_algo.digest()
+            return
 
-        return RTMR(rtmr)
+        with fobj:
+            fobj.seek(start)
+            # data : not yet parsed data, starting at offset in the log
+            data = b''
+            offset = start
+            eof = False
+            while offset < self._log_length:
+                view = memoryview(data)
+                if len(view) >= 8:
+                    blob = BinaryBlob(view, self._log_base + offset)
+                    rtmr, _ = blob.get_uint32(0)
+                    etype, _ = blob.get_uint32(4)
+                    if rtmr == 0xFFFFFFFF:
+                        return
+
+                    if etype == TDEventLogType.EV_NO_ACTION:
+                        event_log_obj = TDEventLogSpecIdHeader(self._log_base + offset)
+                    else:
+                        event_log_obj = TDEventLogEntry(self._log_base + offset,
+                            self._specid_header)
+                    try:
+                        event_log_obj.parse(view)
+                    except AssertionError:
+                        # the entry is not complete, read the next chunk
+                        if eof:
+                            raise
+                        event_log_obj = None
+
+                    if event_log_obj is not None:
+                        # the entries keep a view on the data, the data is
+                        # released with them
+                        data = view[event_log_obj.length:]
+                        offset += event_log_obj.length
+                        if etype == TDEventLogType.EV_NO_ACTION:
+                            self._specid_header = event_log_obj
+                        else:
+                            yield event_log_obj
+                        continue
+
+                if eof:
+                    LOG.error("Truncated event log in %s", ccel_file)
+                    return
+                chunk = fobj.read(min(chunk_size, self._log_length - offset - len(view)))
+                eof = len(chunk) == 0
+                data = bytes(view) + chunk
 
     def get_rtmr_by_index(self, index: int) -> RTMR:
         """
@@ -334,58 +386,89 @@ class TDEventLogActor:
         """
         return self._rtmrs[index]
 
-    def find_hash(self, digest) -> None:
+    def find_hash(self, digest, first=False) -> List[TDEventLogEntry]:
         """
-        Find event log with given digest
+        Find event log with given digest (hex string, any algorithm)
+        If first is True, the search stops at the first matching event log
+        The digest index is used if the log has been processed, otherwise
+        the log is streamed.
         """
-        self.process()
+        raw_digest = bytes.fromhex(digest)
+        if self._complete:
+            candidates = self._digest_index.get(raw_digest, [])
+        else:
+            candidates = (event_log for event_log in self.iter_events()
+                          if raw_digest in event_log.digests)
+
         events = []
-        for event_log in self._event_logs:
-            if digest == event_log.digests[0].hex():
-                LOG.info("= Found event log with matching digest:")
-                LOG.info(f"== Digest: {digest}")
-                LOG.info("== Matched event log:")
-                event_log.dump()
-                events.append(event_log)
+        for event_log in candidates:
+            LOG.info("= Found event log with matching digest:")
+            LOG.info(f"== Digest: {digest}")
+            LOG.info("== Matched event log:")
+            event_log.dump()
+            events.append(event_log)
+            if first:
+                break
         return events
 
+    def find_hashes(self, digests) -> Dict[str, List[TDEventLogEntry]]:
+        """
+        Find the event logs of a list of digests (hex strings) in one pass,
+        for example to check a manifest of expected measurements
+        Returns {digest: [event logs]}, with an empty list for the digests
+        not found in the event log
+        """
+        self.process()
+        return {digest: self._digest_index.get(bytes.fromhex(digest), [])
+                for digest in digests}
+
+    @property
+    def digest_index(self) -> Dict[bytes, List[TDEventLogEntry]]:
+        """
+        Index of the event logs by raw digest, for all algorithms
+        """
+        self.process()
+        return self._digest_index
+
     def process(self) -> None:
         """
         Factory process raw data and generate entries
         """
 
         # skip if event log is already built
-        if self._specid_header is not None:
+        if self._complete:
             return
 
-        if self._read() is None:
-            return
-
-        index = 0
-        count = 0
-        blob = BinaryBlob(self._data, self._log_base)
-
-        while index < self._log_length:
-            start = index
-            rtmr, index = blob.get_uint32(index)
-            etype, index = blob.get_uint32(index)
-
-            if rtmr == 0xFFFFFFFF:
-                break
-
-            if etype == TDEventLogType.EV_NO_ACTION:
-                self._specid_header = TDEventLogSpecIdHeader(
-                    self._log_base + start)
-                self._specid_header.parse(self._data[start:])
-                index = start + self._specid_header.length
-            else:
-                event_log_obj = TDEventLogEntry(self._log_base + start,
-                    self._specid_header)
-                event_log_obj.parse(self._data[start:])
-                index = start + event_log_obj.length
-                self._event_logs.append(event_log_obj)
+        self._event_logs = []
+        self._digest_index = {}
+        self._add_event_logs(self.iter_events())
+        self._complete = self._specid_header is not None
 
-            count += 1
+    def _add_event_logs(self, event_logs) -> List[TDEventLogEntry]:
+        added = []
+        for event_log in event_logs:
+            self._event_logs.append(event_log)
+            for digest in event_log.digests:
+                self._digest_index.setdefault(bytes(digest), []).append(event_log)
+            added.append(event_log)
+        if len(self._event_logs) > 0:
+            last = self._event_logs[-1]
+            self._processed_length = last.address - self._log_base + last.length
+        elif self._specid_header is not None:
+            self._processed_length = self._specid_header.length
+        return added
+
+    def refresh(self) -> List[TDEventLogEntry]:
+        """
+        Parse the entries appended to the log since it has been processed
+        (runtime measurements), the processed entries are not parsed again
+        Returns the new entries
+        """
+        if not self._complete:
+            self.process()
+            return self._event_logs
+        return self._add_event_logs(
+            self._parse(self._ccel_file, self.CHUNK_SIZE, self._processed_length))
 
     def replay(self) -> Dict[int, RTMR]:
         """
@@ -394,23 +477,31 @@ class TDEventLogActor:
         """
         self.process()
 
-        # result dictionary for classifying event logs by rtmr index
-        # the key is a integer, which represents rtmr index
-        # the value is a list of event log entries whose rtmr index is equal to
-        # its related key
-        event_logs_by_index = {}
-        for index in range(RTMR.RTMR_COUNT):
-            event_logs_by_index[index] = []
+        # the registers are only extended with the event logs that have not
+        # been replayed yet (see refresh)
+        self._rtmr_replay.extend_all(self._event_logs[self._rtmr_replay.count:])
+        self._rtmrs = self._rtmr_replay.values()
+        return self._rtmrs
 
-        for event_log in self._event_logs:
-            event_logs_by_index[event_log.rtmr].append(event_log)
-
-        rtmr_by_index = {}
-        for rtmr_index, event_logs in event_logs_by_index.items():
-            rtmr_value = TDEventLogActor._replay_single_rtmr(event_logs)
-            rtmr_by_index[rtmr_index] = rtmr_value
+    @property
+    def rtmr_replay(self) -> RTMRReplay:
+        """
+        Replay engine, with the RTMR values after each event log
+        """
+        self.replay()
+        return self._rtmr_replay
 
-        self._rtmrs = rtmr_by_index
+    def first_diverging_event(self, reference, rtmr_index: int):
+        """
+        First event log of a register whose replay differs from the replay
+        of a reference event log actor (a golden log for example)
+        Returns None if the register replays are identical or if this log
+        is a prefix of the reference log
+        """
+        position = self.rtmr_replay.first_divergence(rtmr_index, reference.rtmr_replay)
+        if position is None or position >= self._rtmr_replay.count_by_index(rtmr_index):
+            return None
+        return self._rtmr_replay.event_log(rtmr_index, position)
 
     def dump_td_event_logs(self, rtmr_index : int = None) -> None:
         """
@@ -469,8 +560,7 @@ def check_initrd():
         ccelobj.log_area_start_address,
         ccelobj.log_area_minimum_length)
 
-    td_event_log_actor.process()
-
-    initrd_digest = sha384(open('/boot/initrd.img','rb').read()).hexdigest()
-    events = td_event_log_actor.find_hash(initrd_digest)
+    initrd_digest = measure_file('/boot/initrd.img')['sha384'].hex()
+    # the initrd is measured once, stop at the first match
+    events = td_event_log_actor.find_hash(initrd_digest, first=True)
     assert len(events) == 1
@@ -17,6 +17,7 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import argparse
 import logging
 import json
 import binascii
@@ -309,4 +310,12 @@ class TdReport(BinaryBlob, dict):
 
 def main():
     logging.basicConfig(level=logging.DEBUG, format='%(message)s')
-    LOG.info("%s", TdReport.get_td_report())
+    parser = argparse.ArgumentParser(description='Get the TDREPORT of the TD')
+    parser.add_argument('-o', '--output', default=None,
+                        help='write the raw TDREPORT to a file (see tdfleetverify)')
+    args = parser.parse_args()
+    report = TdReport.get_td_report()
+    LOG.info("%s", report)
+    if args.output is not None:
+        with open(args.output, 'wb') as fobj:
+            fobj.write(report.data)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Per-VM resource telemetry
+
+A background thread samples the resources used by the qemu process
+of each machine:
+ - /proc/<pid>/stat : CPU time
+ - /proc/<pid>/status : RSS, number of threads
+ - /proc/<pid>/smaps_rollup : private memory mapped by qemu (anonymous
+   memory, guest memory of a normal VM), the private memory of a TD is
+   in guest_memfd, not mapped by qemu, and is not accounted
+ - /proc/<pid>/task/<tid>/stat : CPU time of each vCPU thread
+ - QMP query-memory-size-summary : guest memory
+ - QMP query-cpus-fast : vCPU thread ids
+
+Example:
+  with telemetry.QemuTelemetry([qm1, qm2], interval=0.5) as t:
+      ... test ...
+  t.save('telemetry.json')
+"""
+
+import json
+import os
+import threading
+import time
+
+import Qemu
+
+# sampling interval (seconds), can be overridden with TDXTEST_TELEMETRY_INTERVAL
+TELEMETRY_INTERVAL = float(os.environ.get('TDXTEST_TELEMETRY_INTERVAL', 1.0))
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+# fields of a sample, in the order of the values in the time series
+SAMPLE_FIELDS = ['time', 'cpu_time', 'cpu_percent', 'rss_kb', 'anon_private_kb',
+                 'threads', 'guest_memory_kb', 'vcpu_time']
+
+def _read_stat(path):
+    """
+    Fields of a /proc/<pid>/stat file, starting at the state field (3rd)
+    The command name is skipped since it can contain spaces
+    """
+    with open(path) as f:
+        content = f.read()
+    return content[content.rindex(')') + 2:].split()
+
+def _read_kv(path):
+    """
+    Values (first number, kB for memory) of a 'Key: value' /proc file
+    """
+    values = {}
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            value = value.split()
+            if len(value) > 0 and value[0].isdigit():
+                values[key] = int(value[0])
+    return values
+
+def cpu_time(pid, tid=None):
+    """
+    CPU time (user + system, seconds) of a process or of one of its threads
+    """
+    path = f'/proc/{pid}/stat' if tid is None else f'/proc/{pid}/task/{tid}/stat'
+    fields = _read_stat(path)
+    # utime and stime are the 14th and 15th fields
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+def read_proc_sample(pid, vcpu_tids=[]):
+    """
+    Resources used by a process (see SAMPLE_FIELDS)
+    """
+    status = _read_kv(f'/proc/{pid}/status')
+    sample = {
+        'time': time.monotonic(),
+        'cpu_time': cpu_time(pid),
+        'rss_kb': status.get('VmRSS'),
+        'threads': status.get('Threads'),
+        'anon_private_kb': None,
+    }
+    try:
+        # private pages mapped in qemu, does not include guest_memfd
+        rollup = _read_kv(f'/proc/{pid}/smaps_rollup')
+        sample['anon_private_kb'] = rollup.get('Private_Clean', 0) + rollup.get('Private_Dirty', 0)
+    except OSError:
+        # smaps_rollup is only available since Linux 4.14
+        pass
+    vcpu_time = []
+    for tid in vcpu_tids:
+        try:
+            vcpu_time.append(cpu_time(pid, tid))
+        except OSError:
+            vcpu_time.append(None)
+    sample['vcpu_time'] = vcpu_time
+    return sample
+
+def _round(value):
+    if isinstance(value, list):
+        return [_round(v) for v in value]
+    if isinstance(value, float):
+        return round(value, 3)
+    return value
+
+class VmTelemetry:
+    """
+    Time series of the resources used by one machine
+    """
+    def __init__(self, qm):
+        self.qm = qm
+        self.name = os.path.basename(qm.workdir_name)
+        # the pid file might not be written yet if qemu has just been started
+        self.pid = qm.proc.pid if qm.proc is not None else qm.pid
+        self.qmp = None
+        self.vcpu_tids = []
+        self.samples = []
+        self._connect_qmp()
+
+    def _connect_qmp(self):
+        if self.qm.telemetry_qmp_file is None:
+            print(f'Telemetry : no QMP data for {self.name} (machine created without telemetry)')
+            return
+        try:
+            self.qmp = Qemu.QemuQmp(self.qm, timeout=5, qmp_file=self.qm.telemetry_qmp_file)
+            cpus = self.qmp.command('query-cpus-fast')
+            self.vcpu_tids = [cpu['thread-id'] for cpu in sorted(cpus, key=lambda c: c['cpu-index'])]
+        except Exception as e:
+            print(f'Telemetry : no QMP data for {self.name} ({e})')
+            self.qmp = None
+
+    def _guest_memory_kb(self):
+        if self.qmp is None:
+            return None
+        try:
+            summary = self.qmp.command('query-memory-size-summary')
+        except Exception:
+            self.qmp = None
+            return None
+        return (summary['base-memory'] + summary.get('plugged-memory', 0)) // 1024
+
+    def close(self):
+        self.qmp = None
+
+    def sample(self):
+        """
+        Take a sample, returns False if the process is gone
+        """
+        try:
+            sample = read_proc_sample(self.pid, self.vcpu_tids)
+        except (FileNotFoundError, ProcessLookupError):
+            return False
+        sample['guest_memory_kb'] = self._guest_memory_kb()
+        sample['cpu_percent'] = None
+        if len(self.samples) > 0:
+            prev = self.samples[-1]
+            elapsed = sample['time'] - prev['time']
+            if elapsed > 0:
+                sample['cpu_percent'] = 100 * (sample['cpu_time'] - prev['cpu_time']) / elapsed
+        self.samples.append(sample)
+        return True
+
+    def summary(self):
+        def peak(field):
+            values = [s[field] for s in self.samples if s[field] is not None]
+            return max(values) if len(values) > 0 else None
+        return {
+            'name': self.name,
+            'pid': self.pid,
+            'samples': len(self.samples),
+            'cpu_time': self.samples[-1]['cpu_time'] if len(self.samples) > 0 else None,
+            'peak_cpu_percent': peak('cpu_percent'),
+            'peak_rss_kb': peak('rss_kb'),
+            'peak_anon_private_kb': peak('anon_private_kb'),
+        }
+
+class QemuTelemetry:
+    """
+    Background sampler of the resources used by a set of machines
+    The machines must be running when the sampler is started
+    """
+    def __init__(self, machines, interval=TELEMETRY_INTERVAL):
+        if isinstance(machines, Qemu.QemuMachine):
+            machines = [machines]
+        self.machines = machines
+        self.interval = interval
+        self.vms = []
+        self.start_time = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.vms = [VmTelemetry(qm) for qm in self.machines]
+        self.start_time = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        active = list(self.vms)
+        while len(active) > 0:
+            active = [vm for vm in active if vm.sample()]
+            # sample at a fixed rate, whatever the sampling duration
+            if self._stop.wait(self.interval - (time.monotonic() - self.start_time) % self.interval):
+                break
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for vm in self.vms:
+            vm.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.stop()
+
+    def summary(self):
+        return [vm.summary() for vm in self.vms]
+
+    def print_summary(self):
+        for s in self.summary():
+            rss = f'{s["peak_rss_kb"] / 1024:.0f}M' if s['peak_rss_kb'] is not None else '-'
+            private = f'{s["peak_anon_private_kb"] / 1024:.0f}M' if s['peak_anon_private_kb'] is not None else '-'
+            cpu = f'{s["peak_cpu_percent"]:.0f}%' if s['peak_cpu_percent'] is not None else '-'
+            print(f'{s["name"]} : {s["samples"]} samples, peak RSS {rss}, '
+                  f'peak anon private {private}, peak CPU {cpu}')
+
+    def to_dict(self):
+        """
+        Compact representation : one list of values (see SAMPLE_FIELDS)
+        per sample, time relative to the sampler start
+        """
+        vms = {}
+        for vm in self.vms:
+            samples = []
+            for s in vm.samples:
+                values = [s[f] for f in SAMPLE_FIELDS]
+                values[0] = values[0] - self.start_time
+                samples.append([_round(v) for v in values])
+            vms[vm.name] = {'pid': vm.pid, 'vcpus': len(vm.vcpu_tids), 'samples': samples}
+        return {'interval': self.interval, 'fields': SAMPLE_FIELDS, 'vms': vms}
+
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.to_dict(), f, separators=(',', ':'))
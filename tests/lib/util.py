@@ -25,6 +25,8 @@ import multiprocessing
 import random
 import os
 
+import capacity
+
 def timeit(func):
     @wraps(func)
     def timeit_wrapper(*args, **kwargs):
@@ -37,12 +39,42 @@ def timeit(func):
         return result
     return timeit_wrapper
 
-def tcp_port_available():
+# range of TCP ports 'start-end' reserved for the machines of this process,
+# set by the parallel runner (lib/scheduler.py) so that the processes that
+# boot machines at the same time never pick the same forwarded port
+PORT_RANGE = os.environ.get('TDXTEST_PORT_RANGE', None)
+_next_port = None
+
+def _port_free(port):
     sock = socket.socket()
-    sock.bind(('', 0))
-    port = sock.getsockname()[1]
-    sock.close()
-    return port
+    try:
+        sock.bind(('', port))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+def tcp_port_available():
+    global _next_port
+    if PORT_RANGE is None:
+        sock = socket.socket()
+        sock.bind(('', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    start, end = [int(p) for p in PORT_RANGE.split('-')]
+    if _next_port is None:
+        _next_port = start
+    # ports are given in turn, a port given to a machine that has not
+    # started qemu yet is not given again
+    for _ in range(end - start):
+        port = _next_port
+        _next_port = start + (_next_port + 1 - start) % (end - start)
+        if _port_free(port):
+            return port
+    raise RuntimeError(f'No TCP port available in {PORT_RANGE}')
 
 def get_max_td_vms():
     """
@@ -55,49 +87,16 @@ def get_max_td_vms():
     TDX key space will only have 63 keys instead of 64.
     The nb of TDX key space can be read from the IA32_MKTME_KEYID_PARTITIONING MSR (0x87)
     """
-    cmd = ['rdmsr', '0x87']
-    rc = subprocess.run(cmd, capture_output=True)
-    assert rc.returncode == 0, "Failed getting max td vms"
-    data = rc.stdout.decode().split()
-    assert len(data) > 0, "Failed getting max td vms"
-    rdmsr = int(data[0], 16)
-    max_td_vms = (rdmsr >> 32) - 1
-    return max_td_vms
+    return capacity.max_td_vms()
 
 def get_memory_free_gb():
-    cmd = ['free', '-hg']
-    rc = subprocess.run(cmd, capture_output=True)
-    assert rc.returncode == 0, "Failed getting free memory"
-    lines = rc.stdout.decode().split('\n')
-    assert len(lines) >= 2, "Invalid response to free command"
-    assert "Mem" in lines[1], "Invalid response to free command"
-    assert len(lines[1].split()) > 3, "Invalid response to free command"
-    free_mem = lines[1].split()[3]
-    assert 'Gi' in free_mem, "Invalid response to free command"
-    return float(free_mem.split('Gi')[0])
+    return capacity.read_meminfo()['MemFree'] / (1024 * 1024)
 
 def get_memory_available_gb():
-    cmd = ['free', '-hg']
-    rc = subprocess.run(cmd, capture_output=True)
-    assert rc.returncode == 0, "Failed getting available memory"
-    lines = rc.stdout.decode().split('\n')
-    assert len(lines) >= 2, "Invalid response to free command"
-    assert "Mem" in lines[1], "Invalid response to free command"
-    assert len(lines[1].split()) > 6, "Invalid response to free command"
-    free_mem = lines[1].split()[6]
-    assert 'Gi' in free_mem, "Invalid response to free command"
-    return float(free_mem.split('Gi')[0])
+    return capacity.read_meminfo()['MemAvailable'] / (1024 * 1024)
 
 def get_current_td_vms():
-    current_td_vms = 0
-    cmd = ['ps', 'wwaux']
-    rc = subprocess.run(cmd, capture_output=True)
-    assert rc.returncode == 0, "Failed getting max td vms"
-    lines = rc.stdout.decode().split('\n')
-    for l in lines:
-        if "qemu-system" in l and "tdx" in l:
-            current_td_vms += 1
-    return current_td_vms
+    return len(capacity.qemu_pids())
 
 def pin_process_on_cpu(pid, cpu):
     cs = subprocess.run(['sudo', 'taskset', '-pc', f'{cpu}', f'{pid}'], capture_output=True)
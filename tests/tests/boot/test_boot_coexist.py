@@ -15,6 +15,7 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import pytest
 import os
 
 from Qemu import QemuEfiMachine, QemuEfiFlashSize, QemuMachineService
@@ -22,6 +23,7 @@ import Qemu
 
 import util
 
+@pytest.mark.resources(tds=1, memory='4G', vcpus=32)
 def test_coexist_boot():
     """
     Boot check
@@ -36,9 +38,9 @@ def test_coexist_boot():
         qm.run()
         qm_normal.run()
 
-        m = Qemu.QemuMonitor(qm)
+        m = Qemu.QemuQmp(qm)
         m.wait_for_state('running')
-        m_normal = Qemu.QemuMonitor(qm_normal)
+        m_normal = Qemu.QemuQmp(qm_normal)
         m_normal.wait_for_state('running')
 
         qm.stop()
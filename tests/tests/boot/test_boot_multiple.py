@@ -17,9 +17,11 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import pytest
 import os
 import Qemu
 
+@pytest.mark.resources(tds=1, memory='2G', vcpus=4)
 def test_4vcpus_1socket_10times(qm):
     """
     Test 4vcpus 1socket 10 times (Intel Case ID 009)
@@ -33,6 +35,7 @@ def test_4vcpus_1socket_10times(qm):
         qm.stop()
 
 
+@pytest.mark.resources(tds=1, memory='2G', vcpus=4)
 def test_4vcpus_2sockets_5times(qm):
     """
     Test 4vcpus 2sockets 5 times (Intel Case ID 010)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from parameterized import parameterized
+
+from Qemu import QemuEfiMachine
+import Qemu
+
+@parameterized.expand([
+    ['normal', QemuEfiMachine.OVMF_Q35, 'snapshot'],
+    ['td', QemuEfiMachine.OVMF_Q35_TDX, 'overlay'],
+])
+def test_snapshot_restore(name, machine, expected_method):
+    """
+    Reset a VM to a previous state 3 times
+    Normal VMs are restored from a snapshot, TDs fall back to
+    the re-creation of the overlay image and a new boot
+    """
+    with Qemu.QemuMachine(name, machine) as qm:
+        qm.run()
+        Qemu.QemuSSH(qm)
+        qm.snapshot()
+
+        for i in range(0,3):
+            m = Qemu.QemuSSH(qm)
+            m.check_exec('echo modified > /root/tdxtest-state && sync')
+
+            result = qm.restore()
+            assert result['method'] == expected_method
+
+            m = Qemu.QemuSSH(qm)
+            ret, _, _ = m.exec_command('test -f /root/tdxtest-state')
+            assert ret != 0, 'VM state has not been restored'
+
+        qm.stop()
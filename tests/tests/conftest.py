@@ -1,13 +1,18 @@
 import os
+import time
 import pytest
 import distro
 import subprocess
 
 import Qemu
 import util
+import common
 
 script_path=os.path.dirname(os.path.realpath(__file__))
 
+# session TD pool (see td_pool), None if not used
+_td_pool = None
+
 # Is platform registered for quote generation
 def is_platform_registered():
     try:
@@ -16,6 +21,13 @@ def is_platform_registered():
         return False
     return True
 
+def pytest_sessionstart(session):
+    """
+    Start time of the test session (TDXTEST_SESSION_START), inherited
+    from the parallel runner that starts a session per test
+    """
+    os.environ.setdefault('TDXTEST_SESSION_START', str(time.time()))
+
 def pytest_runtest_setup(item):
     """
     Test setup function
@@ -25,6 +37,12 @@ def pytest_runtest_setup(item):
         if not is_platform_registered():
             pytest.skip('Platform not registered, skip quote generation test')
 
+    # the machines of the TD pool must not run along the tests that need
+    # the whole host or reload kvm_intel
+    if _td_pool is not None and \
+       (item.get_closest_marker('exclusive') is not None or 'release_kvm_use' in item.fixturenames):
+        _td_pool.drain()
+
 @pytest.fixture(autouse=True)
 def run_before_and_after_tests(tmpdir):
     """
@@ -49,6 +67,30 @@ def pytest_exception_interact(node, call, report):
         # enable debug flag to avoid cleanup to happen
         Qemu.QemuMachine.set_debug(True)
 
+@pytest.fixture(scope='session')
+def test_ready_image():
+    """
+    Build (once, see common.build_test_ready_image) the guest image layer
+    with the test tree deployed and set up, used as backing image of the
+    machines of the guest fixtures (qm, td_pool, leased_td), the machines
+    created by the tests themselves use the base guest image
+    The host only tests do not build it.
+    Set TDXTEST_PREBAKE=0 to use the base guest image, if TDXTEST_PREBAKE=1
+    is set, a build failure is an error, otherwise the base image is used
+    """
+    prebake = os.environ.get('TDXTEST_PREBAKE', None)
+    if prebake == '0':
+        yield None
+        return
+    try:
+        layer = common.build_test_ready_image()
+    except Exception as e:
+        if prebake == '1':
+            raise RuntimeError('Failed building the test-ready image (TDXTEST_PREBAKE=1)') from e
+        print(f'Failed building the test-ready image, use the base image : {e}')
+        layer = None
+    yield layer
+
 @pytest.fixture()
 def release_kvm_use():
     """
@@ -57,13 +99,46 @@ def release_kvm_use():
     Qemu.QemuMachine.stop_all_running_qemus()
 
 @pytest.fixture()
-def qm():
+def qm(test_ready_image):
     """
     Fixture to create a QEMU machine as context manager
     """
-    with Qemu.QemuMachine() as qm:
+    with Qemu.QemuMachine(base_image=test_ready_image) as qm:
         yield qm
 
+@pytest.fixture(scope='session')
+def td_pool(test_ready_image):
+    """
+    Session pool of booted TDs (see Qemu.QemuMachinePool)
+    The pool size is set with TDXTEST_POOL_SIZE (0 disables the pool)
+    """
+    size = int(os.environ.get('TDXTEST_POOL_SIZE', 2))
+    if size <= 0:
+        yield None
+        return
+    global _td_pool
+    pool = Qemu.QemuMachinePool(size, base_image=test_ready_image)
+    _td_pool = pool
+    yield pool
+    _td_pool = None
+    pool.close()
+
+@pytest.fixture()
+def leased_td(td_pool, test_ready_image):
+    """
+    Fixture to get a booted TD from the session pool
+    Only for tests that do not modify the VM configuration,
+    the TD is discarded after the test
+    """
+    if td_pool is None:
+        with Qemu.QemuMachine(base_image=test_ready_image) as qm:
+            qm.run()
+            yield qm
+        return
+    qm = td_pool.lease()
+    yield qm
+    td_pool.release(qm)
+
 @pytest.fixture()
 def cpu_core():
     """
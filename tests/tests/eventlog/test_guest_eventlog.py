@@ -24,13 +24,11 @@ import Qemu
 import util
 from common import *
 
-def test_guest_eventlog(qm):
+def test_guest_eventlog(leased_td):
     """
     Dump event log
     """
-    qm.run()
-
-    m = Qemu.QemuSSH(qm)
+    m = Qemu.QemuSSH(leased_td)
 
     deploy_and_setup(m)
 
@@ -38,20 +36,14 @@ def test_guest_eventlog(qm):
     for l in stderr.readlines():
         print(l.rstrip())
 
-    qm.stop()
-
-def test_guest_eventlog_initrd(qm):
+def test_guest_eventlog_initrd(leased_td):
     """
     Check presence of event log for initrd measurement
     """
-    qm.run()
-
-    m = Qemu.QemuSSH(qm)
+    m = Qemu.QemuSSH(leased_td)
 
     deploy_and_setup(m)
 
     stdout, stderr = m.check_exec('tdeventlog_check_initrd')
     for l in stderr.readlines():
         print(l.rstrip())
-
-    qm.stop()
@@ -17,6 +17,7 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import pytest
 import os
 import subprocess
 import time
@@ -25,6 +26,9 @@ import re
 import Qemu
 import util
 
+# host CPUs are put offline
+pytestmark = pytest.mark.exclusive
+
 script_path=os.path.dirname(os.path.realpath(__file__))
 
 def test_guest_cpu_off(qm, cpu_core):
@@ -17,6 +17,7 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import pytest
 import os
 import subprocess
 import time
@@ -25,6 +26,9 @@ import re
 import Qemu
 import util
 
+# the kvm_intel module is reloaded
+pytestmark = pytest.mark.exclusive
+
 script_path=os.path.dirname(os.path.realpath(__file__))
 
 def test_guest_noept_fail(qm, release_kvm_use, tdx_version):
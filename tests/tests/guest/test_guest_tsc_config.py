@@ -27,7 +27,7 @@ import util
 
 script_path=os.path.dirname(os.path.realpath(__file__))
 
-def test_guest_tsc_config(qm):
+def test_guest_tsc_config(leased_td):
     """
     tdx_tsc_config test case (See https://github.com/intel/tdx/wiki/Tests)
     """
@@ -42,10 +42,8 @@ def test_guest_tsc_config(qm):
     # calculate tsc value
     tsc_host = ecx * ebx / eax
 
-    qm.run()
-
     # Get cpuid value from guest and parse it
-    m = Qemu.QemuSSH(qm)
+    m = Qemu.QemuSSH(leased_td)
     out_str = ''
     [outlines, err] = m.check_exec('cpuid -rl 0x15 -1')
     for l in outlines.readlines():
@@ -61,8 +59,6 @@ def test_guest_tsc_config(qm):
     output = stdout.read().decode('utf-8')
     assert 'tsc: Detected' in output
 
-    qm.stop()
-
 
 def test_guest_set_tsc_frequency(qm):
     """
@@ -86,21 +82,17 @@ def test_guest_set_tsc_frequency(qm):
     tsc_guest = ecx * ebx / eax
     assert tsc_guest == tsc_frequency, "TSC frequency not set correctly"
 
-def test_guest_tsc_deadline_enable(qm):
+def test_guest_tsc_deadline_enable(leased_td):
     """
     tdx_tsc_deadline_enable test case (See https://github.com/intel/tdx/wiki/Tests)
     """
-    qm.run()
-
-    m = Qemu.QemuSSH(qm)
+    m = Qemu.QemuSSH(leased_td)
 
     stdout, _ = m.check_exec('lscpu')
     output = stdout.read().decode('utf-8')
     assert 'Flags' in output
     assert 'tsc_deadline_timer' in output
 
-    qm.stop()
-
 def test_guest_tsc_deadline_disable(qm):
     """
     tdx_tsc_deadline_disable test case (See https://github.com/intel/tdx/wiki/Tests)
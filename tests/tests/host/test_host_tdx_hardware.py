@@ -15,10 +15,14 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import pytest
 import os
 import subprocess
 import tdxtools
 
+# host only tests, no VM
+pytestmark = pytest.mark.resources(tds=0, memory='0', vcpus=0)
+
 def test_host_tdx_hardware_enabled():
     """
     Check if host is TDX capabled
@@ -17,10 +17,14 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import pytest
 import re
 import subprocess
 import tdxtools
 
+# host only tests, no VM
+pytestmark = pytest.mark.resources(tds=0, memory='0', vcpus=0)
+
 def test_host_tdx_cpu():
     """
     Check that the CPU has TDX support enabled
@@ -15,6 +15,7 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import pytest
 import os
 
 from parameterized import parameterized
@@ -23,6 +24,13 @@ from Qemu import QemuEfiMachine, QemuEfiFlashSize
 import Qemu
 
 import util
+import kvmstat
+import ptsresults
+
+# measurements must not be disturbed by other tests
+pytestmark = pytest.mark.exclusive
+
+script_path=os.path.dirname(os.path.realpath(__file__))
 
 @parameterized.expand([
     ['normal', QemuEfiMachine.OVMF_Q35],
@@ -31,6 +39,8 @@ import util
 def test_run_perf(name, machine):
     """
     Run benchmark.sh script on TD VM and VM
+    The KVM counters of the run (exits, page faults, ...) are written
+    to kvmstat-{name}.json (see lib/kvmstat.py)
     """
     qm = Qemu.QemuMachine(name,
                                machine,
@@ -39,13 +49,55 @@ def test_run_perf(name, machine):
     try:
         test_profile='tdx_memory'
         m = Qemu.QemuSSH(qm)
-        script_path=os.path.dirname(os.path.realpath(__file__))
         qm.rsync_file(f'{script_path}/../lib/pts', '/')
         m.ssh_conn.exec_command('chmod a+x /pts/benchmark.sh')
-        _, stdout, _ = m.ssh_conn.exec_command(f'/pts/benchmark.sh {test_profile} &> /pts/benchmark-{name}.txt')
-        assert (0 == stdout.channel.recv_exit_status()), 'benchmark run failed !'
+        with kvmstat.KvmStats(qm) as stats:
+            _, stdout, _ = m.ssh_conn.exec_command(f'/pts/benchmark.sh {test_profile} &> /pts/benchmark-{name}.txt')
+            assert (0 == stdout.channel.recv_exit_status()), 'benchmark run failed !'
+        print(f'KVM counters ({name}) :')
+        stats.print_top()
+        stats.save(f'{script_path}/kvmstat-{name}.json')
         m.get(f'/pts/benchmark-{name}.txt', f'{script_path}/benchmark-{name}.txt')
         m.get(f'/pts/benchmark.csv', f'{script_path}/benchmark-{name}.csv')
+        m.get(f'/pts/composite.xml', f'{script_path}/benchmark-{name}.xml')
         m.poweroff()
     except Exception as e:
         pytest.fail('Error : %s' % (e))
+
+def test_perf_overhead():
+    """
+    TDX overhead per benchmark, computed from the results of test_run_perf
+    (benchmark-normal.csv and benchmark-td.csv) of the current session,
+    the direction of the results (lower or higher is better) is read from
+    the PTS result files (benchmark-normal.xml and benchmark-td.xml)
+    The report is written to pts-overhead.json and appended to the
+    history (TDXTEST_PTS_HISTORY, default: pts-overhead-history.json),
+    the overheads are compared with the previous report of the history
+    """
+    results = {}
+    directions = {}
+    for name in ['normal', 'td']:
+        for fname in [f'{script_path}/benchmark-{name}.csv', f'{script_path}/benchmark-{name}.xml']:
+            if not os.path.exists(fname):
+                pytest.skip(f'No benchmark results : {fname}')
+            # results of a previous session (test_run_perf failed or not run)
+            if os.path.getmtime(fname) < float(os.environ['TDXTEST_SESSION_START']):
+                pytest.skip(f'Benchmark results from a previous session : {fname}')
+        results[name] = ptsresults.parse_pts_csv(f'{script_path}/benchmark-{name}.csv')
+        directions.update(ptsresults.parse_pts_composite(f'{script_path}/benchmark-{name}.xml'))
+
+    report = ptsresults.OverheadReport(results['normal'], results['td'], directions)
+    assert len(report.benchmarks) > 0, 'No benchmark in both results'
+
+    history_file = ptsresults.PTS_HISTORY
+    if history_file is None:
+        history_file = f'{script_path}/pts-overhead-history.json'
+    history = ptsresults.OverheadHistory(history_file)
+    print(report.diff(history.last()))
+
+    report.save(f'{script_path}/pts-overhead.json')
+    history.append(report)
+    history.save()
+
+    unknown = [title for title, b in report.benchmarks.items() if b['overhead'] is None]
+    assert len(unknown) == 0, f'No result direction in the PTS result files for : {unknown}'
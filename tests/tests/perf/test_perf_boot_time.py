@@ -15,33 +15,84 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import pytest
+import os
+
 from parameterized import parameterized
 
 from Qemu import QemuEfiMachine, QemuEfiFlashSize
 import Qemu
 
 import util
+from bootprofile import BootProfiler
+import benchmark
+
+# measurements must not be disturbed by other tests
+pytestmark = pytest.mark.exclusive
+
+script_path=os.path.dirname(os.path.realpath(__file__))
 
-@parameterized.expand([
+boot_configs = [
     ['normal', QemuEfiMachine.OVMF_Q35,'2G'],
     ['td', QemuEfiMachine.OVMF_Q35_TDX,'2G'],
     ['normal_16G', QemuEfiMachine.OVMF_Q35,'16G'],
     ['td_16G', QemuEfiMachine.OVMF_Q35_TDX,'16G'],
     ['normal_64G', QemuEfiMachine.OVMF_Q35,'64G'],
     ['td_64G', QemuEfiMachine.OVMF_Q35_TDX,'64G'],
-])
+]
+
+@parameterized.expand(boot_configs)
 def test_boot_time(name, machine, memory):
     """
     Boot time statistics for Normal VM and TD VM
+    The boot time is split into phases (see bootprofile.BootProfiler)
+    and the profile is written to boot-profile-{name}.json
     """
     qm = Qemu.QemuMachine(name,
                           machine,
                           memory=memory)
-    def boot_vm_and_wait_ssh():
-        qm.run()
-        m = Qemu.QemuSSH(qm, timeout=200)
 
     with qm:
-        util.timeit(boot_vm_and_wait_ssh)()
+        profiler = BootProfiler(qm)
+        profile = profiler.boot(timeout=200)
+        print(f'Boot time {name} : {profile["total"]:.4f} seconds')
+        for phase, duration in profile['phases'].items():
+            if duration is not None:
+                print(f'  {phase:<10} : {duration:.4f} seconds')
+        profiler.save(f'{script_path}/boot-profile-{name}.json')
 
         qm.stop()
+
+@parameterized.expand(boot_configs)
+def test_boot_time_benchmark(name, machine, memory):
+    """
+    Boot time statistics over several runs for Normal VM and TD VM
+    Settings (environment variables):
+      - TDXTEST_BENCH_WARMUP, TDXTEST_BENCH_REPEAT : nb of warmup and measured runs
+      - TDXTEST_BENCH_HISTORY : results history (JSON), exported to CSV alongside
+      - TDXTEST_BENCH_BASELINE : baseline (JSON), the test fails if the boot time
+        exceeds the baseline by more than TDXTEST_BENCH_THRESHOLD (ratio)
+      - TDXTEST_BENCH_UPDATE_BASELINE=1 : store the results as new baseline
+        if there is no regression against the previous baseline
+    """
+    result = benchmark.BootBenchmark(name, machine, memory=memory).run()
+    stats = result['stats']
+    print(f'Boot time {name} : mean={stats["mean"]:.4f} stddev={stats["stddev"]:.4f} '
+          f'p50={stats["p50"]:.4f} p95={stats["p95"]:.4f} p99={stats["p99"]:.4f}')
+
+    history_file = benchmark.BENCH_HISTORY
+    if history_file is None:
+        history_file = f'{script_path}/boot-time-history.json'
+    history = benchmark.BenchmarkHistory(history_file)
+    history.append(result)
+    history.save()
+    history.to_csv(os.path.splitext(history_file)[0] + '.csv')
+
+    if benchmark.BENCH_BASELINE is not None:
+        baseline = benchmark.BenchmarkBaseline(benchmark.BENCH_BASELINE)
+        regressions = baseline.check(result)
+        # a regressed result must not become the reference of the next runs
+        if benchmark.BENCH_UPDATE_BASELINE and len(regressions) == 0:
+            baseline.update(result)
+            baseline.save()
+        assert len(regressions) == 0, f'Boot time regression : {regressions}'
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import pytest
+import os
+import json
+import warnings
+
+from parameterized import parameterized
+
+from Qemu import QemuEfiMachine
+import Qemu
+from common import *
+
+# measurements must not be disturbed by other tests
+pytestmark = pytest.mark.exclusive
+
+script_path=os.path.dirname(os.path.realpath(__file__))
+
+@parameterized.expand([
+    ['normal', QemuEfiMachine.OVMF_Q35],
+    ['td', QemuEfiMachine.OVMF_Q35_TDX]
+])
+def test_microbench(name, machine):
+    """
+    Run the guest microbenchmarks (tdmicrobench, see tdxtools.microbench)
+    on TD VM and VM, the distributions are written to microbench-{name}.json
+    """
+    with Qemu.QemuMachine(name, machine) as qm:
+        qm.run()
+        m = Qemu.QemuSSH(qm)
+        deploy_and_setup(m)
+
+        m.check_exec('tdmicrobench -o /tmp/microbench.json')
+        m.get('/tmp/microbench.json', f'{script_path}/microbench-{name}.json')
+        qm.stop()
+
+    with open(f'{script_path}/microbench-{name}.json') as f:
+        results = json.load(f)
+    for bench, r in results.items():
+        if 'skipped' in r:
+            print(f'{bench:<25} : skipped ({r["skipped"]})')
+            continue
+        print(f'{bench:<25} : p50={r["p50"]:.3f} p95={r["p95"]:.3f} '
+              f'p99={r["p99"]:.3f} {r["unit"]} ({r["count"]} samples)')
+
+    if name == 'td':
+        # the TD specific benchmarks must run in a TD
+        for bench in ['tdreport', 'cpuid']:
+            assert 'skipped' not in results[bench], f'{bench} skipped in TD : {results[bench]["skipped"]}'
+        # MMIO from user space needs the support of the guest kernel
+        if 'skipped' in results['mmio']:
+            warnings.warn(f'mmio skipped in TD : {results["mmio"]["skipped"]}')
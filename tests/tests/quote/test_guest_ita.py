@@ -36,6 +36,8 @@ def test_guest_measurement_trust_authority_success():
     check_ita_output(quote_str, for_success = True)
 
 @pytest.mark.quote_generation
+# qgsd is stopped, all quote generations on the host fail meanwhile
+@pytest.mark.exclusive
 def test_guest_measurement_trust_authority_failure():
     """
     Trust Authority CLI quote generation failure
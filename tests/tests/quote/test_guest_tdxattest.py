@@ -96,7 +96,7 @@ def test_guest_tdxattest_vsock_wrong_qgs_addr(qm):
     The quote generation request should succeed because
     vsock is enabled and tdxattest should fallback to use vsock
     """
-    qm.qcmd.add_vsock(10)
+    qm.qcmd.add_vsock(11)
 
     machine = qm.qcmd.plugins['machine']
     machine.enable_qgs_addr(addr = {'type': 'vsock', 'cid':'3','port':'4050'})
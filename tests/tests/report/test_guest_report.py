@@ -24,16 +24,12 @@ import Qemu
 import util
 from common import *
 
-def test_guest_report(qm):
+def test_guest_report(leased_td):
     """
     Boot measurements check
     """
-    qm.run()
-
-    m = Qemu.QemuSSH(qm)
+    m = Qemu.QemuSSH(leased_td)
 
     deploy_and_setup(m)
 
     m.check_exec(f'python3 {guest_workdir}/lib/guest/test_tdreport.py')
-
-    qm.stop()
@@ -15,6 +15,8 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import pytest
+import asyncio
 import os
 
 from Qemu import QemuEfiMachine, QemuEfiFlashSize
@@ -32,3 +34,26 @@ def test_stress_boot():
             qm.run()
             m = Qemu.QemuSSH(qm)
             qm.stop()
+
+@pytest.mark.exclusive
+def test_stress_boot_async():
+    """
+    Boot TDs concurrently in loop, all lifecycles are driven
+    by a single asyncio event loop
+    """
+    nb_tds = min(16, util.get_max_td_vms() - util.get_current_td_vms())
+    assert nb_tds > 0, "No available space for TD VMs"
+
+    async def boot(qm):
+        async with qm:
+            await qm.run()
+            await qm.qmp.wait_for_state('running')
+            return await qm.wait_ready(timeout=100)
+
+    async def boot_all(machines):
+        return await asyncio.gather(*[boot(qm) for qm in machines])
+
+    for i in range(0,10):
+        print(f'\nBooting {nb_tds} TDs nb={i}')
+        durations = asyncio.run(boot_all([Qemu.QemuMachineAsync() for _ in range(nb_tds)]))
+        print(f'Boot times : {["%.2f" % d for d in durations]}')
@@ -21,8 +21,14 @@ import pytest
 
 import Qemu
 import util
+import telemetry
 
-def test_stress_huge_resource_vm(qm):
+# these tests use all the host resources (memory, CPUs, TD slots)
+pytestmark = pytest.mark.exclusive
+
+script_path=os.path.dirname(os.path.realpath(__file__))
+
+def test_stress_huge_resource_vm():
     """
     Test huge resources  (Intel Case ID 007)
     """
@@ -31,14 +37,19 @@ def test_stress_huge_resource_vm(qm):
     huge_mem_gb = int(util.get_memory_free_gb() / 2)
     num_cpus = int(multiprocessing.cpu_count() / 2)
 
-    qm.qcmd.plugins['cpu'].nb_cores = num_cpus
-    qm.qcmd.plugins['memory'].memory = '%dG' % (huge_mem_gb)
-    qm.run()
+    with Qemu.QemuMachine(telemetry=True) as qm:
+        qm.qcmd.plugins['cpu'].nb_cores = num_cpus
+        qm.qcmd.plugins['memory'].memory = '%dG' % (huge_mem_gb)
+        qm.run()
 
-    # huge guest memory -> increase the timeout to give more time to guest to boot
-    ssh = Qemu.QemuSSH(qm, timeout=100)
+        # record the resources used by the VM during the boot
+        with telemetry.QemuTelemetry(qm) as t:
+            # huge guest memory -> increase the timeout to give more time to guest to boot
+            ssh = Qemu.QemuSSH(qm, timeout=100)
+        t.print_summary()
+        t.save(f'{script_path}/telemetry-huge-resource-vm.json')
 
-    qm.stop()
+        qm.stop()
 
 def test_stress_memory_limit_resource_vm(qm):
     """
@@ -112,21 +123,16 @@ def test_stress_max_guests():
 
     print(f'The limit number of TDs is : {max_td_vms}')
 
-    qm = [None] * max_td_vms
-
-    # initialize machines
-    for i in range(max_td_vms):
-        qm[i] = Qemu.QemuMachine()
+    qm = [Qemu.QemuMachine(telemetry=True) for _ in range(max_td_vms)]
+    fleet = Qemu.QemuFleet(qm)
 
-    # start machines
-    for i in range(max_td_vms):
-        print("Starting machine %d" % (i))
-        qm[i].run()
+    # start machines and wait for all machines running
+    timings = fleet.run_and_wait(timeout=100)
+    for i, t in enumerate(timings):
+        print(f'Machine {i} ready after {t["boot"]:.2f} seconds')
 
-    # wait for all machines running
-    for i in range(max_td_vms):
-        print("Waiting for machine %d" % (i))
-        ssh = Qemu.QemuSSH(qm[i], timeout=100)
+    # record the resources used by all the TDs
+    sampler = telemetry.QemuTelemetry(qm).start()
 
     # try to run a new TD
     # expect qemu quit immediately with a specific error message
@@ -139,15 +145,9 @@ def test_stress_max_guests():
         #   - TDX ioctl KVM_TDX_INIT_VM failed, hw_errors: 0x0: No space left on device
         check_qemu_fail_to_start(one_more, error_msg="No space left on device")
 
-    # stop all machines
-    for i in range(max_td_vms):
-        print("Stopping machine %d" % (i))
-        qm[i].shutdown()
+    sampler.stop()
+    sampler.print_summary()
+    sampler.save(f'{script_path}/telemetry-max-guests.json')
 
-    # wait for all machines to exit
-    for i in range(max_td_vms):
-        print("Stopping machine %d" % (i))
-        try:
-            qm[i].communicate()
-        except:
-            pass
+    # stop all machines
+    fleet.stop()
@@ -16,6 +16,7 @@
 #
 
 import os
+import pytest
 import subprocess
 import threading
 import time
@@ -25,7 +26,9 @@ from common import deploy_and_setup
 
 # Global Variables
 script_path=os.path.dirname(os.path.realpath(__file__))
-guest_cid=25
+
+# the host iperf3 server listens on the default vsock port
+pytestmark = pytest.mark.host_lock('vsock')
 
 # Helper Functions
 
@@ -45,6 +48,7 @@ def test_vsock_vm_client(qm):
     """
     vsock vm guest client and host as server (Intel Case ID: 028)
     """
+    guest_cid = 25
     qm.qcmd.add_vsock(guest_cid)
     qm.run()
 
@@ -66,6 +70,7 @@ def test_vsock_vm_server(qm):
     """
     vsock vm guest server and host as client (Intel Case ID: 027)
     """
+    guest_cid = 26
     qm.qcmd.add_vsock(guest_cid)
     qm.run()
 